@@ -0,0 +1,56 @@
+from django.db import migrations
+
+# Notify the masternode whenever a champion or a match becomes 'new', so it
+# does not have to poll the database. The payload is left empty on purpose:
+# PostgreSQL folds identical notifications sent in a single transaction, so a
+# bulk launch of thousands of matches only wakes up the masternode once.
+NOTIFY_TRIGGERS = {
+    'stechec_champion': 'stechec_champion_new',
+    'stechec_match': 'stechec_match_new',
+}
+
+CREATE_TRIGGER = '''
+    CREATE OR REPLACE FUNCTION {table}_notify_new() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{channel}', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER {table}_notify_new
+        AFTER INSERT OR UPDATE OF status ON {table}
+        FOR EACH ROW WHEN (NEW.status = 'new')
+        EXECUTE PROCEDURE {table}_notify_new();
+'''
+
+DROP_TRIGGER = '''
+    DROP TRIGGER IF EXISTS {table}_notify_new ON {table};
+    DROP FUNCTION IF EXISTS {table}_notify_new();
+'''
+
+
+def create_triggers(apps, schema_editor):
+    # LISTEN/NOTIFY is PostgreSQL-only, the masternode requires it anyway
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, channel in NOTIFY_TRIGGERS.items():
+        schema_editor.execute(
+            CREATE_TRIGGER.format(table=table, channel=channel)
+        )
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table in NOTIFY_TRIGGERS:
+        schema_editor.execute(DROP_TRIGGER.format(table=table))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('stechec', '0009_match_priority'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
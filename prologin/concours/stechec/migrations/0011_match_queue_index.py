@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stechec', '0010_notify_new_tasks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(
+                fields=['status', '-priority', 'id'],
+                name='stechec_match_queue_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stechec', '0011_match_queue_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(
+                fields=['status', 'priority', 'author', 'id'],
+                name='stechec_match_author_idx',
+            ),
+        ),
+    ]
@@ -467,6 +467,18 @@ class Match(ExportModelOperationsMixin('match'), models.Model):
         ordering = ["-ts"]
         verbose_name = "match"
         verbose_name_plural = "matches"
+        indexes = [
+            # Used by the masternode to fetch the match queue page by page
+            models.Index(
+                fields=['status', '-priority', 'id'],
+                name='stechec_match_queue_idx',
+            ),
+            # Used by the masternode to share the queue between authors
+            models.Index(
+                fields=['status', 'priority', 'author', 'id'],
+                name='stechec_match_author_idx',
+            ),
+        ]
 
     @classmethod
     def launch_bulk(cls, matches, priority=MatchPriority.DEFAULT):
@@ -25,6 +25,7 @@ import prologin.log
 
 from .monitoring import (
     monitoring_start,
+    masternode_artifact_queue,
     masternode_tasks,
     masternode_workers,
 )
@@ -72,10 +73,11 @@ if __name__ == '__main__':
     logging.getLogger('aiohttp.web').setLevel(logging.WARNING)
 
     # Monitoring
-    masternode_tasks.set_function(
-        lambda: sum(len(w.tasks) for w in s.workers.values())
-    )
+    masternode_tasks.set_function(lambda: len(s.tasks))
     masternode_workers.set_function(lambda: len(s.workers))
+    masternode_artifact_queue.set_function(
+        lambda: s.artifact_writer.queue.qsize()
+    )
     monitoring_start()
 
     try:
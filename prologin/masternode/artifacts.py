@@ -0,0 +1,132 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import os
+import time
+
+from pathlib import Path
+from typing import Dict, Union
+
+from .monitoring import masternode_artifact_write
+
+# Match artifacts streamed by the workers, and their file name on disk
+MATCH_ARTIFACTS = {
+    'dump': 'dump.json.gz',
+    'replay': 'replay.gz',
+    'stats': 'server_stats.yaml.gz',
+}
+
+
+def write_files(files: Dict[Path, Union[bytes, str]]):
+    """Write the given files and wait for them to be on disk."""
+    for path, content in files.items():
+        if isinstance(content, str):
+            content = content.encode()
+        with path.open('wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def commit_part(f, part_path: Path, path: Path):
+    """Make the spooled file `f` durable, and rename it to `path`."""
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    except BaseException:
+        f.close()
+        part_path.unlink()
+        raise
+    f.close()
+    os.replace(part_path, path)
+
+
+class ArtifactWriter:
+    """Write-behind writer for the task artifacts.
+
+    The artifacts are written to the shared contest directory from a thread
+    pool, so that a slow filesystem does not stall the event loop. Writes
+    are queued in a bounded queue: when it is full, `write()` and
+    `write_stream()` wait for a free spot, which slows down the producers
+    instead of piling up buffers in memory.
+    """
+
+    def __init__(self, writers=4, queue_size=64):
+        self.writers = writers
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            writers, thread_name_prefix='artifact-writer'
+        )
+
+    def start(self):
+        for _ in range(self.writers):
+            asyncio.Task(self.writer_task())
+
+    async def write(self, files: Dict[Path, Union[bytes, str]]):
+        """Write the given files, return once they are durable on disk."""
+        loop = asyncio.get_event_loop()
+        await self.submit(
+            lambda: loop.run_in_executor(self.executor, write_files, files)
+        )
+
+    async def write_stream(self, path: Path, stream, chunk_size=1024 * 1024):
+        """Write an aiohttp stream to `path` chunk by chunk.
+
+        The stream arrives at the pace of the network of the worker, it is
+        spooled to a temporary file without holding a writer. Only the final
+        flush and rename are queued, and readers never see a partial
+        artifact.
+        """
+        loop = asyncio.get_event_loop()
+        part_path = path.with_name('.' + path.name + '.part')
+        f = await loop.run_in_executor(self.executor, part_path.open, 'wb')
+        try:
+            async for chunk in stream.iter_chunked(chunk_size):
+                await loop.run_in_executor(self.executor, f.write, chunk)
+        except BaseException:
+            f.close()
+            part_path.unlink()
+            raise
+        await self.submit(
+            lambda: loop.run_in_executor(
+                self.executor, commit_part, f, part_path, path
+            )
+        )
+
+    async def submit(self, job):
+        """Queue `job`, a coroutine function, and wait for its result."""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((job, future))
+        return await future
+
+    async def writer_task(self):
+        while True:
+            job, future = await self.queue.get()
+            start = time.monotonic()
+            try:
+                result = await job()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                masternode_artifact_write.observe(time.monotonic() - start)
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.queue.task_done()
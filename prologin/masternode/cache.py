@@ -0,0 +1,195 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+
+from base64 import b64encode
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+from .monitoring import (
+    masternode_compilation_cache_hit,
+    masternode_compilation_cache_miss,
+    masternode_champion_cache_hit,
+    masternode_champion_cache_miss,
+    masternode_champion_cache_size,
+)
+
+
+def read_champion(path: Path) -> Tuple[str, str]:
+    """Return the hash and the base64 encoding of a compiled tarball."""
+    content = path.read_bytes()
+    return hashlib.sha256(content).hexdigest(), b64encode(content).decode()
+
+
+class ChampionCache:
+    """Content-addressed cache of the compiled champions.
+
+    Champions are identified by the sha256 of their compiled tarball, which
+    is what gets sent to the workers. Hashes are remembered per champion id
+    and tarball mtime/size, so a recompiled champion gets a new hash.
+
+    The base64-encoded payloads are kept in an in-memory LRU cache, the least
+    recently used entries being evicted once the total size of the cached
+    payloads exceeds `max_size` bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        # champion id -> ((mtime, size) of its tarball, hash)
+        self.digests = {}
+        # hash -> path of a tarball, and number of champions having it
+        self.paths = {}
+        self.refs = collections.Counter()
+
+    async def get_hash(self, champion_id: int, path: Path) -> str:
+        loop = asyncio.get_event_loop()
+        st = await loop.run_in_executor(None, path.stat)
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = self.digests.get(champion_id)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        digest, payload = await loop.run_in_executor(None, read_champion, path)
+        # The champion was recompiled, forget its previous hash
+        cached = self.digests.get(champion_id)
+        if cached is not None:
+            self.release(cached[1])
+        self.digests[champion_id] = (stamp, digest)
+        self.refs[digest] += 1
+        self.paths[digest] = path
+        masternode_champion_cache_miss.inc()
+        self.put(digest, payload)
+        return digest
+
+    def release(self, digest: str):
+        self.refs[digest] -= 1
+        if self.refs[digest] <= 0:
+            del self.refs[digest]
+            self.paths.pop(digest, None)
+
+    async def get(self, digest: str) -> str:
+        """Return the base64-encoded tarball of the given hash.
+
+        Raise a KeyError if the hash does not belong to a known champion.
+        """
+        try:
+            payload = self.entries[digest]
+        except KeyError:
+            masternode_champion_cache_miss.inc()
+        else:
+            masternode_champion_cache_hit.inc()
+            self.entries.move_to_end(digest)
+            return payload
+
+        path = self.paths[digest]
+        loop = asyncio.get_event_loop()
+        content_digest, payload = await loop.run_in_executor(
+            None, read_champion, path
+        )
+        if content_digest != digest:
+            # The champion was recompiled since we hashed it
+            raise KeyError(digest)
+        self.put(digest, payload)
+        return payload
+
+    def put(self, digest: str, payload: str):
+        if len(payload) > self.max_size:
+            return
+        if digest in self.entries:
+            self.size -= len(self.entries.pop(digest))
+        self.entries[digest] = payload
+        self.size += len(payload)
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+        masternode_champion_cache_size.set(self.size)
+
+
+# Status of the champion after the compilation, in the compilation cache
+STATUS_FILE = 'status'
+
+
+class CompilationCache:
+    """On-disk cache of the compilation results.
+
+    Results are keyed by the sha256 of the champion sources and by the
+    version of the toolchain compiling them, so that identical sources are
+    only compiled once. An entry is a directory holding the files written in
+    the champion directory after its compilation, and the resulting status
+    of the champion.
+
+    Without a path, nothing is cached.
+    """
+
+    def __init__(self, path: Optional[os.PathLike], toolchain_version=''):
+        self.path = Path(path) if path else None
+        self.toolchain_version = str(toolchain_version)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def entry_path(self, digest: str) -> Path:
+        key = hashlib.sha256(
+            '{}:{}'.format(self.toolchain_version, digest).encode()
+        ).hexdigest()
+        return self.path / key[:2] / key
+
+    def get(self, digest: str) -> Optional[Tuple[str, Dict[str, bytes]]]:
+        """Return the status and the files of the compilation of the given
+        sources."""
+        path = self.entry_path(digest)
+        try:
+            status = (path / STATUS_FILE).read_text()
+            files = {
+                p.name: p.read_bytes()
+                for p in path.iterdir()
+                if p.name != STATUS_FILE
+            }
+        except FileNotFoundError:
+            masternode_compilation_cache_miss.inc()
+            return None
+        masternode_compilation_cache_hit.inc()
+        return status, files
+
+    def put(
+        self, digest: str, status: str, files: Dict[str, Union[bytes, str]]
+    ):
+        path = self.entry_path(digest)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so that a partial entry is never visible
+        tmp_path = Path(tempfile.mkdtemp(dir=path.parent, prefix='.'))
+        try:
+            for name, content in files.items():
+                if isinstance(content, str):
+                    content = content.encode()
+                (tmp_path / name).write_bytes(content)
+            (tmp_path / STATUS_FILE).write_text(status)
+            os.rename(tmp_path, path)
+        except OSError:
+            # Most likely cached concurrently by another masternode
+            shutil.rmtree(tmp_path, ignore_errors=True)
@@ -19,8 +19,45 @@
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
 import aiopg
+import asyncio
 import psycopg2
 
+# Notification channels fed by the triggers of the concours database, see
+# prologin/concours/stechec/migrations/0010_notify_new_tasks.py
+CHANNELS = {
+    'compilation': 'stechec_champion_new',
+    'matches': 'stechec_match_new',
+}
+
+# Map contents are not aggregated in the match queries, they are fetched
+# separately with get_maps to avoid sending the same map for every match.
+MATCHES_QUERY = '''
+          WITH page AS ({page})
+          SELECT
+            page.id AS match_id,
+            page.priority AS priority,
+            page.map_id AS map_id,
+            match_author.username AS author_name,
+            array_agg(stechec_champion.id) AS champion_ids,
+            array_agg(stechec_matchplayer.id) AS match_player_ids,
+            array_agg(auth_user.username) AS user_names
+          FROM
+            page
+          LEFT JOIN auth_user AS match_author
+            ON page.author_id = match_author.id
+          LEFT JOIN stechec_matchplayer
+            ON stechec_matchplayer.match_id = page.id
+          LEFT JOIN stechec_champion
+            ON stechec_matchplayer.champion_id = stechec_champion.id
+          LEFT JOIN auth_user
+            ON stechec_champion.author_id = auth_user.id
+          GROUP BY
+            page.id, page.priority, page.map_id, match_author.username
+          ORDER BY
+            page.priority DESC,
+            page.id ASC
+'''
+
 REQUESTS = {
     'get_champions': '''
           SELECT
@@ -32,6 +69,9 @@ REQUESTS = {
             ON auth_user.id = stechec_champion.author_id
           WHERE
             stechec_champion.status = %(champion_status)s
+          ORDER BY
+            stechec_champion.id ASC
+          LIMIT %(limit)s
     ''',
     'set_champion_status': '''
           UPDATE
@@ -41,30 +81,122 @@ REQUESTS = {
           WHERE
             stechec_champion.id = %(champion_id)s
     ''',
-    'get_matches': '''
+    # Fetch at most `limit` matches, starting after the (priority, id) keyset
+    # cursor if given.
+    'get_matches': MATCHES_QUERY.format(
+        page='''
+            SELECT
+              stechec_match.id AS id,
+              stechec_match.priority AS priority,
+              stechec_match.map_id AS map_id,
+              stechec_match.author_id AS author_id
+            FROM
+              stechec_match
+            WHERE
+              stechec_match.status = %(match_status)s
+              AND (
+                %(after_id)s IS NULL
+                OR stechec_match.priority < %(after_priority)s
+                OR (
+                  stechec_match.priority = %(after_priority)s
+                  AND stechec_match.id > %(after_id)s
+                )
+              )
+            ORDER BY
+              stechec_match.priority DESC,
+              stechec_match.id ASC
+            LIMIT %(limit)s
+        '''
+    ),
+    # Fetch at most `limit` matches, taking the first match of every
+    # (priority, author) pair, then the second one, etc. so that the
+    # masternode can share the slots fairly between the authors. The pairs
+    # are listed with a loose index scan of stechec_match_author_idx, which
+    # only costs one index lookup per pair whatever the size of the backlog.
+    'get_matches_per_author': MATCHES_QUERY.format(
+        page='''
+            WITH RECURSIVE match_authors(priority, author_id) AS (
+              (
+                SELECT
+                  stechec_match.priority,
+                  stechec_match.author_id
+                FROM
+                  stechec_match
+                WHERE
+                  stechec_match.status = %(match_status)s
+                ORDER BY
+                  stechec_match.priority ASC,
+                  stechec_match.author_id ASC
+                LIMIT 1
+              )
+              UNION ALL
+              SELECT
+                next_author.priority,
+                next_author.author_id
+              FROM
+                match_authors
+              CROSS JOIN LATERAL (
+                SELECT
+                  stechec_match.priority,
+                  stechec_match.author_id
+                FROM
+                  stechec_match
+                WHERE
+                  stechec_match.status = %(match_status)s
+                  AND (stechec_match.priority, stechec_match.author_id)
+                    > (match_authors.priority, match_authors.author_id)
+                ORDER BY
+                  stechec_match.priority ASC,
+                  stechec_match.author_id ASC
+                LIMIT 1
+              ) AS next_author
+            )
+            SELECT
+              ranked_match.id AS id,
+              ranked_match.priority AS priority,
+              ranked_match.map_id AS map_id,
+              ranked_match.author_id AS author_id
+            FROM (
+              SELECT
+                author_match.*,
+                row_number() OVER (
+                  PARTITION BY author_match.priority, author_match.author_id
+                  ORDER BY author_match.id
+                ) AS author_rank
+              FROM
+                match_authors
+              CROSS JOIN LATERAL (
+                SELECT
+                  stechec_match.id,
+                  stechec_match.priority,
+                  stechec_match.map_id,
+                  stechec_match.author_id
+                FROM
+                  stechec_match
+                WHERE
+                  stechec_match.status = %(match_status)s
+                  AND stechec_match.priority = match_authors.priority
+                  AND stechec_match.author_id = match_authors.author_id
+                ORDER BY
+                  stechec_match.id ASC
+                LIMIT %(limit)s
+              ) AS author_match
+            ) AS ranked_match
+            ORDER BY
+              ranked_match.priority DESC,
+              ranked_match.author_rank ASC,
+              ranked_match.id ASC
+            LIMIT %(limit)s
+        '''
+    ),
+    'get_maps': '''
           SELECT
-            stechec_match.id AS match_id,
-            stechec_map.contents AS map_contents,
-            array_agg(stechec_champion.id) AS champion_ids,
-            array_agg(stechec_matchplayer.id) AS match_player_ids,
-            array_agg(auth_user.username) AS user_names
+            stechec_map.id AS id,
+            stechec_map.contents AS contents
           FROM
-            stechec_match
-          LEFT JOIN stechec_map
-            ON stechec_match.map_id = stechec_map.id
-          LEFT JOIN stechec_matchplayer
-            ON stechec_matchplayer.match_id = stechec_match.id
-          LEFT JOIN stechec_champion
-            ON stechec_matchplayer.champion_id = stechec_champion.id
-          LEFT JOIN auth_user
-            ON stechec_champion.author_id = auth_user.id
+            stechec_map
           WHERE
-            stechec_match.status = %(match_status)s
-          GROUP BY
-            stechec_match.id, stechec_map.id
-          ORDER BY
-            stechec_match.priority DESC,
-            stechec_match.id ASC
+            stechec_map.id = ANY(%(map_ids)s)
     ''',
     'set_match_status': '''
           UPDATE
@@ -75,14 +207,36 @@ REQUESTS = {
             stechec_match.id = %(match_id)s
             AND status <> 'done'
     ''',
-    'set_player_score': '''
+    # Write all the player scores and the match status in a single statement,
+    # hence a single transaction and round trip. The scores of a match that is
+    # already done, e.g. on a duplicate result, are left untouched.
+    'set_match_result': '''
+          WITH match AS (
+            UPDATE
+              stechec_match
+            SET
+              status = %(match_status)s
+            WHERE
+              stechec_match.id = %(match_id)s
+              AND status <> 'done'
+            RETURNING
+              stechec_match.id
+          )
           UPDATE
             stechec_matchplayer
           SET
-            score = %(player_score)s,
-            has_timeout = %(player_timeout)s
+            score = player.score,
+            has_timeout = player.has_timeout
+          FROM
+            match,
+            unnest(
+              %(player_ids)s::integer[],
+              %(player_scores)s::integer[],
+              %(player_timeouts)s::boolean[]
+            ) AS player(id, score, has_timeout)
           WHERE
-            stechec_matchplayer.id = %(player_id)s
+            stechec_matchplayer.id = player.id
+            AND stechec_matchplayer.match_id = match.id
     ''',
 }
 
@@ -96,16 +250,47 @@ class ConcoursQuery:
         self.database = config['sql']['database']
         self.pool = None
 
+    @property
+    def dsn_params(self):
+        return {
+            'database': self.database,
+            'user': self.user,
+            'password': self.password,
+            'host': self.host,
+            'port': self.port,
+        }
+
     async def connect(self):
         if self.pool is None:
-            self.pool = await aiopg.create_pool(
-                database=self.database,
-                user=self.user,
-                password=self.password,
-                host=self.host,
-                port=self.port,
-                maxsize=64,
-            )
+            self.pool = await aiopg.create_pool(maxsize=64, **self.dsn_params)
+
+    async def listen(self, channels, callback, check_interval=30):
+        """Subscribe to the given notification channels.
+
+        `callback` is called with the channel name every time a notification
+        is received. This coroutine runs until it is cancelled, or raises if
+        the connection to the database is lost.
+        """
+        # LISTEN is bound to a session, so it needs its own connection
+        conn = await aiopg.connect(**self.dsn_params)
+        try:
+            async with conn.cursor() as cursor:
+                for channel in channels:
+                    await cursor.execute('LISTEN {}'.format(channel))
+            while True:
+                try:
+                    notify = await asyncio.wait_for(
+                        conn.notifies.get(), check_interval
+                    )
+                except asyncio.TimeoutError:
+                    if conn.closed:
+                        raise psycopg2.OperationalError(
+                            'lost the notification connection'
+                        )
+                    continue
+                callback(notify.channel)
+        finally:
+            conn.close()
 
     async def execute(self, name, params):
         if name not in REQUESTS:
@@ -120,13 +305,3 @@ class ConcoursQuery:
                 except psycopg2.ProgrammingError:  # No results
                     return None
         return res
-
-    async def executemany(self, name, seq_of_params):
-        if name not in REQUESTS:
-            raise AttributeError('No such request')
-
-        await self.connect()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                for p in seq_of_params:
-                    await cursor.execute(REQUESTS[name], p)
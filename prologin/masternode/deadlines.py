@@ -0,0 +1,65 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class Deadlines:
+    """Min-heap of deadlines, on the time.monotonic() clock.
+
+    Entries are never removed nor moved: when an entry expires, its owner
+    checks whether it still applies, and schedules it again if the deadline
+    was pushed back in the meantime. This keeps updates of the deadlines, e.g.
+    on every heartbeat, free.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()  # Never compare the items
+        self.changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, deadline, item):
+        if not self.heap or deadline < self.heap[0][0]:
+            # The waiter sleeps until the previous earliest deadline
+            self.changed.set()
+        heapq.heappush(self.heap, (deadline, next(self.counter), item))
+
+    def pop_expired(self):
+        """Remove and return the items whose deadline has passed."""
+        now = time.monotonic()
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expired.append(heapq.heappop(self.heap)[2])
+        return expired
+
+    async def wait(self):
+        """Wait until the earliest deadline, or until an earlier one is
+        scheduled."""
+        self.changed.clear()
+        timeout = None
+        if self.heap:
+            timeout = max(self.heap[0][0] - time.monotonic(), 0)
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
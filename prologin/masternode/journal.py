@@ -0,0 +1,117 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+
+from pathlib import Path
+from typing import Optional
+
+# The journal is not compacted below this number of records
+COMPACT_MIN_RECORDS = 1000
+
+
+class TaskJournal:
+    """Append-only journal of the tasks running on the workers.
+
+    It lets a restarted masternode know which task was running on which
+    worker, and since when. Each line is a JSON list, either
+    ["add", kind, id, hostname, port, since] or ["del", kind, id], `since`
+    being a UNIX timestamp. The journal is compacted when it is opened, and
+    once it holds more than twice as many records as running tasks.
+
+    Without a path, nothing is journaled.
+    """
+
+    def __init__(self, path: Optional[os.PathLike]):
+        self.path = Path(path) if path else None
+        self.file = None
+        self.entries = {}
+        self.records = 0
+
+    def load(self):
+        """Return the journaled tasks as {(kind, id): (hostname, port, since)}.
+
+        Lines that cannot be parsed, e.g. a line truncated by a crash, are
+        ignored.
+        """
+        entries = {}
+        if self.path is None:
+            return entries
+        try:
+            f = self.path.open()
+        except FileNotFoundError:
+            return entries
+        with f:
+            for line in f:
+                try:
+                    op, kind, task_id, *infos = json.loads(line)
+                    if op == 'add':
+                        hostname, port, since = infos
+                        entries[(kind, task_id)] = (hostname, port, since)
+                    elif op == 'del':
+                        entries.pop((kind, task_id), None)
+                except ValueError:
+                    logging.warning('ignoring bad journal line: %r', line)
+        return entries
+
+    def open(self, entries):
+        """Rewrite the journal with the given entries, then open it."""
+        if self.path is None:
+            return
+        self.entries = dict(entries)
+        self.records = len(self.entries)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('w') as f:
+            for (kind, task_id), infos in entries.items():
+                f.write(self._line('add', kind, task_id, *infos))
+        os.replace(tmp_path, self.path)
+        self.file = self.path.open('a')
+
+    def add(self, key, hostname, port, since):
+        kind, task_id = key
+        self._write(self._line('add', kind, task_id, hostname, port, since))
+        self.entries[key] = (hostname, port, since)
+
+    def remove(self, key):
+        kind, task_id = key
+        self._write(self._line('del', kind, task_id))
+        self.entries.pop(key, None)
+        if self.records > max(COMPACT_MIN_RECORDS, 2 * len(self.entries)):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the journal with the running tasks only."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.open(self.entries)
+
+    @staticmethod
+    def _line(*args):
+        return json.dumps(args) + '\n'
+
+    def _write(self, line):
+        if self.file is None:
+            return
+        # Flushing is enough to survive a crash of the masternode, losing
+        # the journal on a crash of the machine only means redispatching.
+        self.file.write(line)
+        self.file.flush()
+        self.records += 1
@@ -18,26 +18,34 @@
 # You should have received a copy of the GNU General Public License
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
+import aiohttp.web
 import asyncio
 import json
 import logging
+import prologin.rpc.client
 import prologin.rpc.server
-import random
+import prologin.rpc.websocket
+import prologin.timeauth
 import time
 
 from base64 import b64decode
 
-from .concoursquery import ConcoursQuery
+from .artifacts import MATCH_ARTIFACTS, ArtifactWriter
+from .cache import ChampionCache, CompilationCache
+from .concoursquery import CHANNELS, ConcoursQuery
+from .deadlines import Deadlines
+from .journal import TaskJournal
+from .scheduler import FairShare, Scheduler
 from .monitoring import (
     masternode_bad_result,
     masternode_client_done_file,
     masternode_match_done_db,
     masternode_match_done_file,
-    masternode_request_compilation_task,
     masternode_task_dispatch,
     masternode_task_redispatch,
     masternode_task_resubmit,
     masternode_task_fail,
+    masternode_worker_disconnect,
     masternode_worker_timeout,
     masternode_zombie_worker,
     masternode_exception,
@@ -50,22 +58,94 @@ from .task import (
 )
 from .worker import Worker
 
+# Results processed at the same time, and waiting to be processed. Workers
+# retry the results rejected when these are exceeded.
+RESULT_CONCURRENCY = 64
+RESULT_QUEUE = 256
+
+# Upper bound of the delay before retrying a task whose dispatch failed
+MAX_RETRY_DELAY = 60
+
+# Deadline of the adoption of the tasks left by a previous masternode
+ADOPTION = 'adoption'
+
 
 class MasterNode(prologin.rpc.server.BaseRPCApp):
     def __init__(self, *args, config=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.app.router.add_route(
+            'PUT',
+            r'/artifact/{hostname}/{port:\d+}/{match_id:\d+}/{name:[a-z]+}',
+            self.put_artifact,
+        )
+        # Workers may open a channel instead of using HTTP calls
+        self.app.router.add_route(
+            'GET', '/ws', prologin.rpc.websocket.handle_channel
+        )
+        self.app.on_cleanup.append(self.close_workers)
         self.config = config
         self.workers = {}
+        self.worker_channels = {}  # (hostname, port) -> WebSocketPeer
+        self.tasks = {}  # (kind, id) -> Worker running the task
+        self.artifact_writer = ArtifactWriter(
+            config['master'].get('artifact_writers', 4),
+            config['master'].get('artifact_queue_size', 64),
+        )
+        self.scheduler = Scheduler(
+            config['master'].get('scheduling_policy', 'spread')
+        )
+        fair_share = config['master'].get('fair_share', {})
+        self.fair_share = None
+        if fair_share.get('enabled', True):
+            self.fair_share = FairShare(
+                fair_share.get('weights'), fair_share.get('default_weight', 1)
+            )
         self.db = ConcoursQuery(config)
+        self.champion_cache = ChampionCache(
+            config['master'].get('champion_cache_MiB', 512) * 1024 * 1024
+        )
+        self.compilation_cache = CompilationCache(
+            config['master'].get('compilation_cache_dir'),
+            config['master'].get('toolchain_version', ''),
+        )
+        # Fallback polling interval, the DB watchers are normally woken up by
+        # database notifications or by workers freeing some slots.
+        self.poll_interval = config['master'].get('poll_interval_secs', 10)
+        self.queue_events = {name: asyncio.Event() for name in CHANNELS}
+        self.queue_backlog = {name: False for name in CHANNELS}
+        self.journal = TaskJournal(config['master'].get('journal_path'))
+        # Tasks left running by a previous masternode, waiting for their
+        # worker to come back: (hostname, port) -> {(kind, id): (task, since)}
+        self.orphans = {}
+        self.journaled = {}
+        self.adoption_deadline = None
+        # Timeouts of the workers and of their tasks, checked by the janitor
+        self.deadlines = Deadlines()
 
     def run(self):
         logging.info("master listening on %s", self.config["master"]["port"])
+        self.artifact_writer.start()
+        self.journaled = self.journal.load()
+        self.journal.open(self.journaled)
+        if self.journaled:
+            logging.info(
+                "%d tasks were running before restart", len(self.journaled)
+            )
         self.janitor = asyncio.Task(self.janitor_task())
+        self.dbnotify = asyncio.Task(self.dbnotify_task())
         self.dbwatcher_compilations = asyncio.Task(
-            self.dbwatcher_task("compilation", self.get_requested_compilations)
+            self.dbwatcher_task(
+                "compilation",
+                self.get_requested_compilations,
+                CompilationTask,
+            )
         )
         self.dbwatcher_matches = asyncio.Task(
-            self.dbwatcher_task("matches", self.get_requested_matches)
+            self.dbwatcher_task(
+                "matches",
+                self.get_requested_matches,
+                MatchTask,
+            )
         )
         super().run(port=self.config["master"]["port"])
 
@@ -76,14 +156,84 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
             d.append((host, port, w.slots, w.max_slots))
         return d
 
+    @prologin.rpc.remote_method
+    async def get_champion(self, champion_hash):
+        return await self.champion_cache.get(champion_hash)
+
+    async def put_artifact(self, request):
+        """Receive a match artifact streamed by the worker running the
+        match."""
+        hostname = request.match_info['hostname']
+        port = int(request.match_info['port'])
+        match_id = int(request.match_info['match_id'])
+        name = request.match_info['name']
+        if name not in MATCH_ARTIFACTS:
+            raise aiohttp.web.HTTPNotFound()
+
+        token = request.headers.get(prologin.rpc.client.HMAC_HEADER)
+        if self.app.secret is not None and not prologin.timeauth.check_token(
+            token,
+            self.app.secret,
+            'artifact/{}/{}/{}/{}'.format(hostname, port, match_id, name),
+        ):
+            raise aiohttp.web.HTTPForbidden()
+
+        # Only the worker running the match may write its artifacts, this
+        # also ignores the artifacts of the tasks we already redispatched
+        w = self.tasks.get((MatchTask.KIND, match_id))
+        if w is None or (w.hostname, w.port) != (hostname, port):
+            raise aiohttp.web.HTTPConflict()
+
+        path = get_match_dir(self.config, match_id) / MATCH_ARTIFACTS[name]
+        with masternode_match_done_file.time():
+            await self.artifact_writer.write_stream(path, request.content)
+        return aiohttp.web.Response(status=204)
+
+    async def channel_opened(self, peer, request):
+        try:
+            key = request.query['hostname'], int(request.query['port'])
+        except (KeyError, ValueError):
+            await peer.close()
+            return
+        logging.info("channel opened by worker %s:%s", *key)
+        self.worker_channels[key] = peer
+        if key in self.workers:
+            self.workers[key].channel = peer
+
+    async def channel_closed(self, peer, request):
+        for key, channel in list(self.worker_channels.items()):
+            if channel is peer:
+                del self.worker_channels[key]
+        for w in list(self.workers.values()):
+            if w.channel is peer:
+                # The worker is gone, no need to wait for its heartbeat
+                masternode_worker_disconnect.inc()
+                logging.warning("channel closed by worker %s", w)
+                w.channel = None
+                await self.redispatch_worker(w)
+
     async def register_worker(self, key, w):
+        w.channel = self.worker_channels.get(key)
         if await w.reachable():
             logging.warning("registered new worker: %s:%s", w.hostname, w.port)
+            if key in self.workers:
+                self.scheduler.remove(self.workers[key])
+                asyncio.create_task(self.workers[key].close())
             self.workers[key] = w
+            self.scheduler.add(w)
+            self.deadlines.schedule(
+                w.last_heartbeat + self.config['worker']['timeout_secs'], w
+            )
+            self.adopt_orphans(w)
         else:
             logging.warning(
                 "dropped unreachable worker: %s:%s", w.hostname, w.port
             )
+            await w.close()
+
+    async def close_workers(self, app):
+        for w in self.workers.values():
+            await w.close()
 
     @prologin.rpc.remote_method
     async def update_worker(self, worker):
@@ -92,6 +242,7 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
         if key not in self.workers:
             w = Worker(hostname, port, slots, max_slots, self.config)
             await self.register_worker(key, w)
+            self.wake_backlogged_queues()
         else:
             logging.debug(
                 "updating worker: %s:%s %s/%s",
@@ -100,7 +251,12 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
                 slots,
                 max_slots,
             )
-            self.workers[key].update(slots, max_slots)
+            w = self.workers[key]
+            freed_slots = slots > w.slots
+            w.update(slots, max_slots)
+            self.scheduler.update(w)
+            if freed_slots:
+                self.wake_backlogged_queues()
 
     @prologin.rpc.remote_method
     async def heartbeat(self, worker, first):
@@ -114,14 +270,30 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
         )
         if first and (hostname, port) in self.workers:
             await self.redispatch_worker(self.workers[(hostname, port)])
+        if first and (hostname, port) in self.orphans:
+            # The worker restarted too, its tasks are lost
+            self.redispatch_orphans(self.orphans.pop((hostname, port)))
         await self.update_worker(worker)
 
-    @prologin.rpc.remote_method
+    async def get_worker(self, hostname, port, slots, max_slots):
+        """Return the worker sending a result, or None for zombie workers.
+
+        A worker whose tasks are waiting to be adopted may send its results
+        before its first heartbeat, it is registered right away.
+        """
+        if (hostname, port) in self.orphans:
+            await self.update_worker((hostname, port, slots, max_slots))
+        return self.workers.get((hostname, port))
+
+    @prologin.rpc.remote_method(
+        max_concurrency=RESULT_CONCURRENCY,
+        max_queue=RESULT_QUEUE,
+        retry_after=5,
+    )
     async def compilation_done(self, worker, user, champion_id, result):
         hostname, port, slots, max_slots = worker
-        try:
-            w = self.workers[(hostname, port)]
-        except KeyError:
+        w = await self.get_worker(hostname, port, slots, max_slots)
+        if w is None:
             # Ignore tasks from zombie workers
             masternode_zombie_worker.inc()
             logging.info(
@@ -138,7 +310,7 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
                 champion_id,
             )
             return
-        w.remove_compilation_task(task)
+        self.remove_task(w, task)
 
         if result['success']:  # Successful compilation
             status = 'ready'
@@ -149,26 +321,46 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
         logging.info('compilation of champion %s: %s', champion_id, status)
 
         champion_path = get_champion_dir(self.config, user, champion_id)
+        files = {}
         if result['stdout'] is not None:
-            (champion_path / 'compilation.log').write_text(result['stdout'])
+            files[champion_path / 'compilation.log'] = result['stdout']
         if result['success'] and result['champion_compiled']:
-            (champion_path / 'champion-compiled.tgz').write_bytes(
-                b64decode(result['champion_compiled'])
+            files[champion_path / 'champion-compiled.tgz'] = b64decode(
+                result['champion_compiled']
             )
-        (champion_path / 'compilation-workernode-result.json').write_text(
+        files[champion_path / 'compilation-workernode-result.json'] = (
             json.dumps(result)
         )
+        # The champion must be on disk before it is marked as ready
+        await self.artifact_writer.write(files)
         await self.db.execute(
             'set_champion_status',
             {'champion_id': champion_id, 'champion_status': status},
         )
+        # Internal errors are not cached, the same sources may compile
+        if status != 'failed' and task.digest is not None:
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None,
+                    self.compilation_cache.put,
+                    task.digest,
+                    status,
+                    {path.name: content for path, content in files.items()},
+                )
+            except OSError:
+                logging.exception(
+                    'cannot cache the compilation of champion %s', champion_id
+                )
 
-    @prologin.rpc.remote_method
+    @prologin.rpc.remote_method(
+        max_concurrency=RESULT_CONCURRENCY,
+        max_queue=RESULT_QUEUE,
+        retry_after=5,
+    )
     async def match_done(self, worker, mid, result):
         hostname, port, slots, max_slots = worker
-        try:
-            w = self.workers[(hostname, port)]
-        except KeyError:
+        w = await self.get_worker(hostname, port, slots, max_slots)
+        if w is None:
             # Ignore tasks from zombie workers
             masternode_zombie_worker.inc()
             logging.info(
@@ -183,7 +375,7 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
                 'discarding result of redispatched match task %s', mid
             )
             return
-        w.remove_match_task(task)
+        self.remove_task(w, task)
 
         if result['success']:
             status = 'done'
@@ -193,45 +385,46 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
         match_path = get_match_dir(self.config, mid)
 
         # Write player logs
+        player_files = {}
         for player_id, player_result in result['players'].items():
             logname = 'log-champ-{}-{}.log'.format(
                 player_id, player_result['champion_id']
             )
-            with masternode_client_done_file.time():
-                if player_result['stdout'] is not None:
-                    (match_path / logname).write_text(player_result['stdout'])
+            if player_result['stdout'] is not None:
+                player_files[match_path / logname] = player_result['stdout']
 
         # Store match artifacts
-        with masternode_match_done_file.time():
-            if result['stdout'] is not None:
-                (match_path / 'server.stdout.log').write_text(result['stdout'])
-            if result['stderr'] is not None:
-                (match_path / 'server.stderr.log').write_text(result['stderr'])
-            if result['dump']:
-                (match_path / 'dump.json.gz').write_bytes(
-                    b64decode(result['dump'])
-                )
-            if result['replay']:
-                (match_path / 'replay.gz').write_bytes(
-                    b64decode(result['replay'])
-                )
-            if result['stats']:
-                (match_path / 'server_stats.yaml.gz').write_bytes(
-                    b64decode(result['stats'])
-                )
-            (match_path / 'server-workernode-result.json').write_text(
-                json.dumps(result)
-            )
+        match_files = {}
+        if result['stdout'] is not None:
+            match_files[match_path / 'server.stdout.log'] = result['stdout']
+        if result['stderr'] is not None:
+            match_files[match_path / 'server.stderr.log'] = result['stderr']
+        # Inline artifacts from workers that do not stream them with
+        # put_artifact
+        for name, filename in MATCH_ARTIFACTS.items():
+            if result.get(name):
+                match_files[match_path / filename] = b64decode(result[name])
+        match_files[match_path / 'server-workernode-result.json'] = json.dumps(
+            result
+        )
+
+        # The artifacts must be on disk before the match is marked as done
+        async def write_player_files():
+            with masternode_client_done_file.time():
+                await self.artifact_writer.write(player_files)
+
+        async def write_match_files():
+            with masternode_match_done_file.time():
+                await self.artifact_writer.write(match_files)
+
+        await asyncio.gather(write_player_files(), write_match_files())
 
         start = time.monotonic()
+        player_scores = []
         if status == 'done':
             try:
                 player_scores = [
-                    {
-                        'player_id': r['player'],
-                        'player_score': r['score'],
-                        'player_timeout': r['nb_timeout'] != 0,
-                    }
+                    (r['player'], r['score'], r['nb_timeout'] != 0)
                     for r in result['match_result']
                 ]
             except KeyError:
@@ -242,125 +435,384 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
                     repr(result['match_result']),
                 )
                 status = 'failed'
-            else:
-                await self.db.executemany('set_player_score', player_scores)
 
-        match_status = {'match_id': mid, 'match_status': status}
-        await self.db.execute('set_match_status', match_status)
+        match_result = {
+            'match_id': mid,
+            'match_status': status,
+            'player_ids': [p[0] for p in player_scores],
+            'player_scores': [p[1] for p in player_scores],
+            'player_timeouts': [p[2] for p in player_scores],
+        }
+        await self.db.execute('set_match_result', match_result)
         masternode_match_done_db.observe(time.monotonic() - start)
 
+    def remove_task(self, worker, task):
+        worker.remove_task(task)
+        if self.tasks.get(task.key) is worker:
+            del self.tasks[task.key]
+            self.journal.remove(task.key)
+
+    def hold_orphans(self, task_cls, tasks):
+        """Keep aside the pending tasks that can be adopted.
+
+        Return the pending tasks that were not journaled, these have to be
+        redispatched.
+        """
+        pending = {task.key for task in tasks}
+        for key in list(self.journaled):
+            if key[0] == task_cls.KIND and key not in pending:
+                # The task ended while the masternode was down
+                del self.journaled[key]
+                self.journal.remove(key)
+
+        held = {key for orphans in self.orphans.values() for key in orphans}
+        to_redispatch = []
+        for task in tasks:
+            if task.key in self.tasks or task.key in held:
+                continue
+            try:
+                hostname, port, since = self.journaled.pop(task.key)
+            except KeyError:
+                to_redispatch.append(task)
+                continue
+            orphans = self.orphans.setdefault((hostname, port), {})
+            orphans[task.key] = (task, since)
+
+        # Give the workers one heartbeat timeout to come back
+        self.adoption_deadline = (
+            time.monotonic() + self.config['worker']['timeout_secs']
+        )
+        if self.orphans:
+            self.deadlines.schedule(self.adoption_deadline, ADOPTION)
+        for worker in list(self.workers.values()):
+            self.adopt_orphans(worker)
+        return to_redispatch
+
+    def adopt_orphans(self, worker):
+        orphans = self.orphans.pop((worker.hostname, worker.port), {})
+        if orphans:
+            logging.info("adopting %d tasks of %s", len(orphans), worker)
+        for task, since in orphans.values():
+            worker.adopt_task(task, since)
+            self.tasks[task.key] = worker
+            self.schedule_task(worker, task)
+
+    def redispatch_orphans(self, orphans):
+        masternode_task_redispatch.inc(len(orphans))
+        for task, _ in orphans.values():
+            self.journal.remove(task.key)
+            asyncio.create_task(task.redispatch())
+
     async def redispatch_worker(self, worker):
         masternode_task_redispatch.inc(len(worker.tasks))
 
         if worker.tasks:
             logging.info(
-                "redispatching tasks for %s: %s", worker, worker.tasks
+                "redispatching tasks for %s: %s",
+                worker,
+                list(worker.tasks.values()),
             )
-            for task in worker.tasks.copy():
+            for task in list(worker.tasks.values()):
+                self.remove_task(worker, task)
                 asyncio.create_task(task.redispatch())
 
         del self.workers[(worker.hostname, worker.port)]
+        self.scheduler.remove(worker)
+        await worker.close()
 
-    async def resubmit_timeout_tasks(self, worker):
-        tasks_to_fail = set()
-        for t in worker.tasks.copy():
-            if t.has_timeout() or t.has_error():
-                max_tries = self.config["worker"]["max_task_tries"]
-                error_msg = f' last error: {t.error}' if t.has_error() else ''
-                if t.executions < max_tries:
-                    msg = (
-                        "resubmitted (try {}/{})".format(
-                            t.executions, max_tries
-                        )
-                        + error_msg
-                    )
-                    masternode_task_resubmit.inc()
-                    asyncio.create_task(t.execute(self, worker))
-                else:
-                    msg = (
-                        "maximum number of retries exceeded, failing task"
-                        + error_msg
-                    )
-                    tasks_to_fail.add(t)
-                logging.info("task %s of %s timeout: %s", t, worker, msg)
+    async def execute_tasks(self, worker, tasks):
+        await worker.execute_tasks(tasks)
+        for task in tasks:
+            if task.has_error():
+                self.schedule_task(worker, task)
+
+    def schedule_task(self, worker, task, restarted=False):
+        """Schedule the next check of the timeout of a task."""
+        if task.has_error() and not restarted:
+            # Retry failed dispatches with an exponential backoff
+            delay = self.config['worker'].get('retry_delay_secs', 1)
+            deadline = time.monotonic() + min(
+                delay * 2 ** max(task.executions - 1, 0), MAX_RETRY_DELAY
+            )
+        elif task.timeout is None:
+            return
+        elif task.start_time is None or restarted:
+            # Check again once the task could have timed out
+            deadline = time.monotonic() + task.timeout
+        else:
+            deadline = task.start_time + task.timeout
+        # Only the latest deadline of a task is checked, the entries it
+        # replaces stay in the heap and are skipped when they expire.
+        task.deadline_generation += 1
+        self.deadlines.schedule(
+            deadline, (worker, task, task.deadline_generation)
+        )
 
-        masternode_task_fail.inc(len(tasks_to_fail))
-        for task in tasks_to_fail:
-            worker.tasks.discard(task)
-            asyncio.create_task(task.fail())
+    async def check_worker(self, worker):
+        if self.workers.get((worker.hostname, worker.port)) is not worker:
+            return
+        timeout = self.config['worker']['timeout_secs']
+        if worker.is_alive(timeout):
+            self.deadlines.schedule(worker.last_heartbeat + timeout, worker)
+            return
+        masternode_worker_timeout.inc()
+        logging.warning("timeout detected for worker %s", worker)
+        await self.redispatch_worker(worker)
+
+    async def check_task(self, worker, t, generation):
+        if worker.get_task(t.key) is not t:
+            # The task is done, or was redispatched
+            return
+        if generation != t.deadline_generation:
+            # Superseded by a later deadline
+            return
+        if not t.has_timeout() and not t.has_error():
+            self.schedule_task(worker, t)
+            return
+
+        max_tries = self.config["worker"]["max_task_tries"]
+        error_msg = f' last error: {t.error}' if t.has_error() else ''
+        if t.executions < max_tries:
+            msg = (
+                "resubmitted (try {}/{})".format(t.executions, max_tries)
+                + error_msg
+            )
+            masternode_task_resubmit.inc()
+            asyncio.create_task(t.execute(self, worker))
+            self.schedule_task(worker, t, restarted=True)
+        else:
+            msg = (
+                "maximum number of retries exceeded, failing task" + error_msg
+            )
+            masternode_task_fail.inc()
+            self.remove_task(worker, t)
+            asyncio.create_task(t.fail())
+        logging.info("task %s of %s timeout: %s", t, worker, msg)
+
+    def check_orphans(self):
+        if not self.orphans or time.monotonic() < self.adoption_deadline:
+            return
+        # These workers did not come back after the restart
+        for key, orphans in self.orphans.items():
+            logging.warning("redispatching orphan tasks of %s:%s", *key)
+            self.redispatch_orphans(orphans)
+        self.orphans = {}
 
     async def janitor_task(self):
+        # Only wakes up when the earliest deadline expires, and only looks at
+        # the expired workers and tasks.
         while True:
-            try:
-                for worker in list(self.workers.values()):
-                    if not worker.is_alive(
-                        self.config['worker']['timeout_secs']
-                    ):
-                        masternode_worker_timeout.inc()
-                        logging.warning(
-                            "timeout detected for worker %s", worker
-                        )
-                        await self.redispatch_worker(worker)
-                    await self.resubmit_timeout_tasks(worker)
-            except asyncio.CancelledError:
-                raise
-            except Exception:
-                masternode_exception.inc()
-                logging.exception('Janitor task triggered an exception')
-            await asyncio.sleep(1)
-
-    async def get_requested_compilations(self, status="new"):
+            for item in self.deadlines.pop_expired():
+                try:
+                    if isinstance(item, Worker):
+                        await self.check_worker(item)
+                    elif item == ADOPTION:
+                        self.check_orphans()
+                    else:
+                        await self.check_task(*item)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    masternode_exception.inc()
+                    logging.exception('Janitor task triggered an exception')
+            await self.deadlines.wait()
+
+    async def get_requested_compilations(self, status="new", limit=None):
         rows = await self.db.execute(
-            "get_champions", {"champion_status": status}
+            "get_champions", {"champion_status": status, "limit": limit}
         )
 
         tasks = [
             CompilationTask(self.config, self.db, username, champion_id)
             for champion_id, username in rows
         ]
+        cached = await asyncio.gather(
+            *(self.complete_from_cache(task) for task in tasks)
+        )
+        tasks = [task for task, hit in zip(tasks, cached) if not hit]
+        if len(tasks) < len(rows):
+            # Fetch the compilations that took the place of the cached ones
+            self.wake_queue('compilation')
 
         return tasks
 
-    async def get_requested_matches(self, status="new"):
-        rows = await self.db.execute("get_matches", {"match_status": status})
+    async def complete_from_cache(self, task):
+        """Complete a compilation with the result of the compilation of
+        identical sources, without sending it to a worker.
+
+        Return whether the compilation was completed, the task is to be
+        dispatched otherwise.
+        """
+        if not self.compilation_cache.enabled:
+            return False
+        loop = asyncio.get_event_loop()
+        try:
+            digest = await loop.run_in_executor(None, task.source_digest)
+            cached = await loop.run_in_executor(
+                None, self.compilation_cache.get, digest
+            )
+        except OSError:
+            # Let a worker report the missing sources
+            return False
+        if cached is None:
+            return False
+
+        status, files = cached
+        logging.info(
+            'compilation of champion %s: %s (cached)', task.champ_id, status
+        )
+        try:
+            await self.artifact_writer.write(
+                {
+                    task.champ_path / name: content
+                    for name, content in files.items()
+                }
+            )
+            await self.db.execute(
+                'set_champion_status',
+                {'champion_id': task.champ_id, 'champion_status': status},
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            masternode_exception.inc()
+            logging.exception(
+                'cannot complete champion %s from the cache', task.champ_id
+            )
+            return False
+        return True
 
+    async def get_requested_matches(self, status="new", limit=None):
         tasks = []
-        for (
-            match_id,
-            map_contents,
-            champion_ids,
-            player_ids,
-            usernames,
-        ) in rows:
-            players = list(zip(champion_ids, player_ids, usernames))
-            try:
-                t = MatchTask(
-                    self.config, self.db, match_id, players, map_contents
+        maps = {}
+        after_priority, after_id = None, None
+
+        # Keep fetching pages after the last seen (priority, id) until we
+        # have enough tasks, as some matches may not be turned into tasks.
+        while limit is None or len(tasks) < limit:
+            page_size = None if limit is None else limit - len(tasks)
+            if self.fair_share is not None and page_size is not None:
+                # Let every author compete for the free slots, the tasks are
+                # then ordered by dispatch_tasks. This query is not paginated.
+                rows = await self.db.execute(
+                    "get_matches_per_author",
+                    {"match_status": status, "limit": page_size},
+                )
+                page_size = None
+            else:
+                rows = await self.db.execute(
+                    "get_matches",
+                    {
+                        "match_status": status,
+                        "limit": page_size,
+                        "after_priority": after_priority,
+                        "after_id": after_id,
+                    },
+                )
+            if not rows:
+                break
+
+            map_ids = {row[2] for row in rows if row[2] is not None}
+            map_ids -= maps.keys()
+            if map_ids:
+                maps.update(
+                    await self.db.execute(
+                        "get_maps", {"map_ids": list(map_ids)}
+                    )
                 )
-                tasks.append(t)
+
+            for (
+                match_id,
+                priority,
+                map_id,
+                author,
+                champion_ids,
+                player_ids,
+                usernames,
+            ) in rows:
+                players = list(zip(champion_ids, player_ids, usernames))
+                try:
+                    t = MatchTask(
+                        self.config,
+                        self.db,
+                        match_id,
+                        players,
+                        maps.get(map_id),
+                        priority=priority,
+                        author=author,
+                    )
+                    await t.hash_champions(self.champion_cache)
+                    tasks.append(t)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    masternode_exception.inc()
+                    logging.exception(
+                        'Unable to create task for match %s', match_id
+                    )
+
+            after_priority, after_id = rows[-1][:2]
+            if page_size is None or len(rows) < page_size:
+                break
+
+        return tasks
+
+    def wake_queue(self, name):
+        self.queue_events[name].set()
+
+    def wake_backlogged_queues(self):
+        # Only wake up the queues that could not be fully dispatched, there is
+        # nothing new to fetch for the others.
+        for name, backlog in self.queue_backlog.items():
+            if backlog:
+                self.wake_queue(name)
+
+    async def wait_for_queue(self, name):
+        event = self.queue_events[name]
+        try:
+            await asyncio.wait_for(event.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    def on_db_notify(self, channel):
+        for name, queue_channel in CHANNELS.items():
+            if channel == queue_channel:
+                self.wake_queue(name)
+
+    async def dbnotify_task(self):
+        while True:
+            # Notifications may have been missed while we were not listening
+            for name in self.queue_events:
+                self.wake_queue(name)
+            try:
+                await self.db.listen(CHANNELS.values(), self.on_db_notify)
             except asyncio.CancelledError:
                 raise
             except Exception:
                 masternode_exception.inc()
-                logging.exception(
-                    'Unable to create task for match %s', match_id
-                )
-
-        return tasks
+                logging.exception('DB notify task triggered an exception')
+            await asyncio.sleep(5)
 
-    async def dbwatcher_task(self, name, fetcher):
+    async def dbwatcher_task(self, name, fetcher, task_cls):
         while True:
             try:
-                # Redispatch pending tasks from previous masternode
-                tasks = await fetcher("pending")
+                # Redispatch pending tasks from previous masternode, unless
+                # they can be adopted once their worker comes back
+                tasks = self.hold_orphans(task_cls, await fetcher("pending"))
                 if tasks:
                     await asyncio.wait([task.redispatch() for task in tasks])
 
                 while True:
-                    tasks = await fetcher()
-                    if tasks:
+                    # Only fetch as many tasks as the cluster can take
+                    limit = self.scheduler.capacity(task_cls.SLOTS_TAKEN)
+                    if not limit:
+                        self.queue_backlog[name] = True
+                    elif tasks := await fetcher(limit=limit):
                         await self.dispatch_tasks(name, tasks)
-                    await asyncio.sleep(1)
+                    else:
+                        self.queue_backlog[name] = False
+                    await self.wait_for_queue(name)
             except asyncio.CancelledError:
                 raise
             except Exception:
@@ -370,35 +822,51 @@ class MasterNode(prologin.rpc.server.BaseRPCApp):
                 continue
 
     def find_worker_for(self, task):
-        available = list(self.workers.values())
-        available = [w for w in available if w.can_add_task(task)]
-        random.shuffle(available)
-        available.sort(key=lambda w: w.usage)
-        if not available:
-            return None
-        else:
-            return available[0]
+        return self.scheduler.find(task.slots_taken)
 
     async def dispatch_tasks(self, queue_name, tasks):
         logging.info("%d tasks in %s queue", len(tasks), queue_name)
 
-        coros = []
+        self.queue_backlog[queue_name] = False
+        if self.fair_share is not None:
+            tasks = self.fair_share.order(tasks)
+        batches = {}
         for task in tasks:
+            if task.key in self.tasks:
+                # The task is already running somewhere, e.g. its status was
+                # not updated yet or its dispatch failed and is being retried
+                logging.debug(
+                    "task %s already dispatched to %s",
+                    task,
+                    self.tasks[task.key],
+                )
+                continue
             w = self.find_worker_for(task)
             if w is None:
                 logging.info("no worker available for task %s", task)
                 # It's okay to break the loop because all the items in the task
                 # queue are expected to have the same requirements, hence if
                 # one task cannot be scheduled then none of the others will.
+                self.queue_backlog[queue_name] = True
                 break
             masternode_task_dispatch.inc()
             try:
-                coros.append(w.add_task(self, task))
+                w.add_task(task)
+                self.scheduler.update(w)
+                self.tasks[task.key] = w
+                self.journal.add(task.key, w.hostname, w.port, time.time())
+                self.schedule_task(w, task)
+                batches.setdefault(w, []).append(task)
+                if self.fair_share is not None:
+                    self.fair_share.charge(task)
                 logging.debug("task %s sent to %s", task, w)
             except Exception:
                 masternode_exception.inc()
                 logging.exception('Could not dispatch task %s to %s', task, w)
 
-        # Ensure the tasks are scheduled (=set as pending).
-        if coros:
-            await asyncio.wait(coros)
+        # Send the tasks of each worker in a single batch, and ensure they are
+        # scheduled (=set as pending).
+        if batches:
+            await asyncio.wait(
+                [self.execute_tasks(w, ts) for w, ts in batches.items()]
+            )
@@ -54,6 +54,14 @@ masternode_client_done_file = Summary(
     'masternode_client_done_file', 'Summary of client done file write'
 )
 
+masternode_artifact_write = Summary(
+    'masternode_artifact_write', 'Summary of artifact writes to disk'
+)
+
+masternode_artifact_queue = Gauge(
+    'masternode_artifact_queue', 'Number of artifact writes waiting in queue'
+)
+
 masternode_match_done_db = Summary(
     'masternode_match_done_db', 'Summary of match done database access'
 )
@@ -62,10 +70,38 @@ masternode_worker_timeout = Gauge(
     'masternode_worker_timeout', 'Number of workers timeout'
 )
 
+masternode_worker_disconnect = Counter(
+    'masternode_worker_disconnect', 'Number of worker channels closed'
+)
+
 masternode_zombie_worker = Counter(
     'masternode_zombie_worker', 'Number of tasks received from unknown workers'
 )
 
+masternode_champion_cache_hit = Counter(
+    'masternode_champion_cache_hit', 'Number of compiled champion cache hits'
+)
+
+masternode_champion_cache_miss = Counter(
+    'masternode_champion_cache_miss',
+    'Number of compiled champion cache misses',
+)
+
+masternode_champion_cache_size = Gauge(
+    'masternode_champion_cache_size',
+    'Size in bytes of the compiled champion cache',
+)
+
+masternode_compilation_cache_hit = Counter(
+    'masternode_compilation_cache_hit',
+    'Number of compilations completed from the cache',
+)
+
+masternode_compilation_cache_miss = Counter(
+    'masternode_compilation_cache_miss',
+    'Number of compilations sent to the workers',
+)
+
 masternode_exception = Counter(
     'masternode_exception',
     'Number of exceptions encountered by the masternode',
@@ -0,0 +1,151 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import random
+
+
+class Scheduler:
+    """Bucket queue of the workers, indexed by their number of free slots.
+
+    It has to be kept up to date by calling `update()` every time the slots
+    of a worker change. Finding a worker for a task then only costs a walk
+    over the distinct numbers of free slots, whatever the size of the
+    cluster. Ties are broken randomly.
+
+    Two policies are available:
+
+    - spread: pick the worker with the most free slots, so that the load is
+      evenly distributed across the cluster.
+    - pack: pick the worker with the fewest free slots that can still fit
+      the task, so that small tasks fill the gaps and whole workers are kept
+      free for the big ones.
+    """
+
+    POLICIES = ('spread', 'pack')
+
+    def __init__(self, policy='spread'):
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown scheduling policy: {policy}')
+        self.policy = policy
+        self.buckets = {}  # free slots -> list of workers
+        self.positions = {}  # worker -> (free slots, index in its bucket)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, worker):
+        bucket = self.buckets.setdefault(worker.slots, [])
+        self.positions[worker] = (worker.slots, len(bucket))
+        bucket.append(worker)
+
+    def remove(self, worker):
+        if worker not in self.positions:
+            return
+        slots, index = self.positions.pop(worker)
+        bucket = self.buckets[slots]
+        last = bucket.pop()
+        if last is not worker:
+            bucket[index] = last
+            self.positions[last] = (slots, index)
+        if not bucket:
+            del self.buckets[slots]
+
+    def update(self, worker):
+        if worker not in self.positions:
+            return
+        if self.positions[worker][0] != worker.slots:
+            self.remove(worker)
+            self.add(worker)
+
+    def find(self, slots_taken):
+        """Return a worker that can run a task of the given size, or None."""
+        fitting = [slots for slots in self.buckets if slots >= slots_taken]
+        if not fitting:
+            return None
+        if self.policy == 'pack':
+            slots = min(fitting)
+        else:
+            slots = max(fitting)
+        return random.choice(self.buckets[slots])
+
+    def capacity(self, slots_taken):
+        """Number of tasks of the given size the cluster can run right now."""
+        return sum(
+            len(bucket) * (slots // slots_taken)
+            for slots, bucket in self.buckets.items()
+            if slots > 0
+        )
+
+
+class FairShare:
+    """Deficit round robin of the tasks across their authors.
+
+    Tasks are served by decreasing priority. Within a priority band, the
+    authors take turns: at each turn an author is credited with its weight,
+    and may run one task per whole credit. A credit is only used when the
+    task is actually dispatched, which the caller reports with `charge()`.
+    The turn order and the credits are kept between calls, so that an
+    author cannot monopolize the slots freed between two dispatch rounds.
+    """
+
+    def __init__(self, weights=None, default_weight=1):
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        for author, weight in [(None, default_weight), *self.weights.items()]:
+            # An author would never get a whole credit, and never a turn
+            if not weight > 0:
+                raise ValueError(
+                    f'fair share weight of {author or "default"} must be '
+                    f'positive: {weight}'
+                )
+        self.deficits = collections.OrderedDict()  # author -> credit
+
+    def weight(self, author):
+        return self.weights.get(author, self.default_weight)
+
+    def order(self, tasks):
+        """Lazily yield the given tasks in fair order."""
+        bands = {}
+        for task in tasks:
+            queues = bands.setdefault(task.priority, {})
+            queues.setdefault(task.author, collections.deque()).append(task)
+
+        for priority in sorted(bands, reverse=True):
+            queues = bands[priority]
+            for author in queues:
+                self.deficits.setdefault(author, 0)
+            while queues:
+                turns = [a for a in self.deficits if a in queues]
+                for author in turns:
+                    # Authors get their turn in the order of their last turn.
+                    # A turn cut short by the caller goes on at the next call,
+                    # with the credits left.
+                    if self.deficits[author] < 1:
+                        self.deficits[author] += self.weight(author)
+                    queue = queues[author]
+                    while queue and self.deficits[author] >= 1:
+                        yield queue.popleft()
+                    self.deficits.move_to_end(author)
+                    if not queue:
+                        del queues[author]
+                        self.deficits[author] = 0
+
+    def charge(self, task):
+        """Use a credit of the author of a task yielded by `order()`."""
+        if task.author in self.deficits:
+            self.deficits[task.author] -= 1
@@ -19,6 +19,8 @@
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
 import abc
+import asyncio
+import hashlib
 import os
 import os.path
 import time
@@ -50,22 +52,48 @@ def get_match_dir(config, match_id: int) -> Path:
 
 
 class Task(abc.ABC):
-    def __init__(self, timeout=None):
+    KIND = None
+    BATCH_KEY = None
+
+    def __init__(self, timeout=None, priority=0, author=None):
         self.start_time = None
         self.timeout = timeout
+        self.priority = priority
+        self.author = author
         self.executions = 0
         self.error = None
+        # Incremented on each schedule of its next check by the janitor
+        self.deadline_generation = 0
 
     @property
     @abc.abstractmethod
     def slots_taken(self):
         raise NotImplementedError
 
-    async def execute(self):
+    @property
+    @abc.abstractmethod
+    def key(self):
+        """(kind, id) tuple identifying the task across the cluster."""
+        raise NotImplementedError
+
+    async def prepare(self):
+        """Get ready to be sent to a worker."""
         self.start_time = time.monotonic()
         self.executions += 1
         self.error = None
 
+    @abc.abstractmethod
+    def batch_args(self):
+        """Arguments of the task in a WorkerNode.run_tasks batch."""
+        raise NotImplementedError
+
+    async def dispatched(self):
+        """Called once the task was accepted by a worker."""
+        pass
+
+    async def execute(self, master, worker):
+        await master.execute_tasks(worker, [self])
+
     @abc.abstractmethod
     async def redispatch(self):
         raise NotImplementedError
@@ -86,21 +114,41 @@ class Task(abc.ABC):
 
 
 class CompilationTask(Task):
+    KIND = 'compilation'
+    BATCH_KEY = 'compilations'
+    SLOTS_TAKEN = 1
+
     def __init__(self, config, db, user, champ_id):
-        super().__init__(timeout=config["worker"]["compilation_timeout_secs"])
+        super().__init__(
+            timeout=config["worker"]["compilation_timeout_secs"], author=user
+        )
         self.db = db
         self.user = user
         self.champ_id = champ_id
         self.champ_path = get_champion_dir(config, user, champ_id)
+        self.ctgz = None
+        self.digest = None
 
     @property
     def slots_taken(self):
-        return 1
+        return self.SLOTS_TAKEN
 
-    async def execute(self, master, worker):
-        await super().execute()
+    @property
+    def key(self):
+        return (self.KIND, self.champ_id)
+
+    def source_digest(self) -> str:
+        """sha256 of the champion sources."""
+        if self.digest is None:
+            self.digest = hashlib.sha256(
+                (self.champ_path / 'champion.tgz').read_bytes()
+            ).hexdigest()
+        return self.digest
+
+    async def prepare(self):
+        await super().prepare()
 
-        ctgz = b64encode(
+        self.ctgz = b64encode(
             (self.champ_path / 'champion.tgz').read_bytes()
         ).decode()
 
@@ -109,7 +157,8 @@ class CompilationTask(Task):
             {"champion_status": "pending", "champion_id": self.champ_id},
         )
 
-        await worker.rpc.compile_champion(self.user, self.champ_id, ctgz)
+    def batch_args(self):
+        return (self.user, self.champ_id, self.ctgz)
 
     async def redispatch(self):
         await self.db.execute(
@@ -128,46 +177,73 @@ class CompilationTask(Task):
 
 
 class MatchTask(Task):
-    def __init__(self, config, db, mid, players, map_contents):
-        super().__init__(timeout=config["worker"]["match_timeout_secs"])
+    KIND = 'match'
+    BATCH_KEY = 'matches'
+    SLOTS_TAKEN = 5
+
+    def __init__(
+        self,
+        config,
+        db,
+        mid,
+        players,
+        map_contents,
+        priority=0,
+        author=None,
+    ):
+        super().__init__(
+            timeout=config["worker"]["match_timeout_secs"],
+            priority=priority,
+            author=author,
+        )
         self.db = db
         self.mid = mid
         self.map_contents = map_contents
-        self.players = {}
+        self.players = {}  # Filled by hash_champions()
         self.match_path = get_match_dir(config, self.mid)
-
-        for (cid, mpid, user) in players:
-            ctgz = b64encode(
-                (
-                    get_champion_dir(config, user, cid)
-                    / 'champion-compiled.tgz'
-                ).read_bytes()
-            ).decode()
-            self.players[mpid] = (cid, ctgz)
+        self.champion_dirs = {
+            mpid: (cid, get_champion_dir(config, user, cid))
+            for cid, mpid, user in players
+        }
+
+    async def hash_champions(self, champions):
+        """Get the hashes of the compiled champions, the workers fetching
+        them by hash."""
+        players = list(self.champion_dirs.items())
+        hashes = await asyncio.gather(
+            *(
+                champions.get_hash(cid, champion_dir / 'champion-compiled.tgz')
+                for _, (cid, champion_dir) in players
+            )
+        )
+        self.players = {
+            mpid: (cid, chash)
+            for (mpid, (cid, _)), chash in zip(players, hashes)
+        }
 
     def __repr__(self):
         return f"<Match: id={self.mid}>"
 
     @property
     def slots_taken(self):
-        return 5
+        return self.SLOTS_TAKEN
 
-    async def execute(self, master, worker):
-        await super().execute()
+    @property
+    def key(self):
+        return (self.KIND, self.mid)
+
+    async def prepare(self):
+        await super().prepare()
 
         try:
             os.makedirs(self.match_path)
         except OSError:
             pass
 
-        try:
-            await worker.rpc.run_match(
-                self.mid, self.players, self.map_contents
-            )
-        except Exception as e:
-            self.error = f'Could not dispatch match: {e}'
-            return
+    def batch_args(self):
+        return (self.mid, self.players, self.map_contents)
 
+    async def dispatched(self):
         # Set the match as pending *after* the RPC call has succeeded.
         await self.db.execute(
             "set_match_status",
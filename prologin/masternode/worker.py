@@ -31,14 +31,23 @@ class Worker(object):
         self.port = port
         self.slots = slots
         self.max_slots = max_slots
-        self.tasks = set()
+        self.tasks = {}  # (kind, id) -> Task
         self.keep_alive()
         self.config = config
-        self.rpc = prologin.rpc.client.Client(
+        # Channel opened by the worker, preferred to HTTP calls when open
+        self.channel = None
+        self.client = prologin.rpc.client.Client(
             "http://{}:{}/".format(self.hostname, self.port),
             secret=self.config['master']['shared_secret'].encode(),
+            encoding=self.config['master'].get('rpc_encoding', 'json'),
         )
 
+    @property
+    def rpc(self):
+        if self.channel is not None and not self.channel.closed:
+            return self.channel
+        return self.client
+
     @property
     def usage(self):
         return 1.0 - (float(self.slots) / self.max_slots)
@@ -51,43 +60,85 @@ class Worker(object):
         except Exception:
             return False
 
+    async def close(self):
+        await self.client.close()
+
     def update(self, slots, max_slots):
         self.slots = slots
         self.max_slots = max_slots
         self.keep_alive()
 
     def keep_alive(self):
-        self.last_heartbeat = time.time()
+        self.last_heartbeat = time.monotonic()
 
     def is_alive(self, timeout):
-        return (time.time() - self.last_heartbeat) < timeout
+        if self.channel is not None and not self.channel.closed:
+            # Disconnections of the channel are detected right away
+            return True
+        return (time.monotonic() - self.last_heartbeat) < timeout
 
     def can_add_task(self, task):
         return self.slots >= task.slots_taken
 
-    def add_task(self, master, task):
+    def add_task(self, task):
         self.slots -= task.slots_taken
-        self.tasks.add(task)
+        self.tasks[task.key] = task
         task.start_time = None
-        return task.execute(master, self)
+
+    def adopt_task(self, task, since):
+        """Take over a task that was started by a previous masternode.
+
+        The slots of the task are already accounted for by the worker, and
+        `since` is the UNIX timestamp at which the task was dispatched.
+        """
+        self.tasks[task.key] = task
+        task.executions = 1
+        task.start_time = time.monotonic() - max(time.time() - since, 0)
+
+    async def execute_tasks(self, tasks):
+        """Send a batch of tasks to the worker in a single remote call."""
+        prepared = await asyncio.gather(
+            *(t.prepare() for t in tasks), return_exceptions=True
+        )
+        batch = {}
+        sent = []
+        for t, exn in zip(tasks, prepared):
+            if isinstance(exn, Exception):
+                t.error = f'Could not prepare task: {exn}'
+                continue
+            batch.setdefault(t.BATCH_KEY, []).append(t.batch_args())
+            sent.append(t)
+        if not sent:
+            return
+
+        try:
+            started = await self.rpc.run_tasks(**batch)
+        except Exception as e:
+            for t in sent:
+                t.error = f'Could not dispatch task: {e}'
+            return
+
+        dispatched = []
+        for t in sent:
+            _, task_id = t.key
+            if task_id in started[t.BATCH_KEY]:
+                dispatched.append(t.dispatched())
+            else:
+                t.error = 'Task rejected by the worker'
+        if dispatched:
+            await asyncio.gather(*dispatched)
+
+    def get_task(self, key):
+        return self.tasks.get(key)
 
     def get_compilation_task(self, champ_id):
-        for t in self.tasks:
-            if isinstance(t, task.CompilationTask) and t.champ_id == champ_id:
-                return t
-        return None
+        return self.get_task((task.CompilationTask.KIND, champ_id))
 
     def get_match_task(self, mid):
-        for t in self.tasks:
-            if isinstance(t, task.MatchTask) and t.mid == mid:
-                return t
-        return None
-
-    def remove_compilation_task(self, task):
-        self.tasks.discard(task)
+        return self.get_task((task.MatchTask.KIND, mid))
 
-    def remove_match_task(self, task):
-        self.tasks.discard(task)
+    def remove_task(self, t):
+        self.tasks.pop(t.key, None)
 
     def __repr__(self):
         return '<Worker: {}:{}>'.format(self.hostname, self.port)
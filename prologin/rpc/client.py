@@ -13,11 +13,21 @@
 
 import asyncio
 import aiohttp
-import json
+import atexit
+import contextlib
+import os
 import prologin.timeauth
 import socket
 import logging
-from urllib.parse import urljoin
+import threading
+import time
+import weakref
+from urllib.parse import urljoin, urlparse
+
+from prologin.rpc import codec, monitoring
+
+# Header carrying the timeauth token of non-RPC requests (e.g. uploads)
+HMAC_HEADER = 'X-Prologin-HMAC'
 
 
 class BaseError(Exception):
@@ -41,28 +51,158 @@ class RemoteError(BaseError):
         super(RemoteError, self).__init__(type, message)
 
 
-class Client:
-    """RPC client: connect to a server and perform remote calls."""
+class OverloadedError(RemoteError):
+    """Raised when the remote method is overloaded and rejected the call.
+
+    The call should be retried after `retry_after` seconds.
+    """
+
+    def __init__(self, type, message, retry_after):
+        super().__init__(type, message)
+        self.retry_after = retry_after
+
+
+def remote_error(data):
+    """Return the RemoteError of an exception reply, as found in batches
+    and channel replies."""
+    if data['exn_type'] == 'Overloaded':
+        return OverloadedError(
+            data['exn_type'],
+            data['exn_message'],
+            float(data.get('retry_after', 1)),
+        )
+    return RemoteError(data['exn_type'], data['exn_message'])
+
 
-    def __init__(self, base_url, secret=None):
+class Client:
+    """RPC client: connect to a server and perform remote calls.
+
+    Calls go through a persistent HTTP session, so that connections to the
+    server are kept alive and reused. At most `max_connections` requests are
+    in flight at the same time, idle connections are closed after
+    `keepalive_timeout` seconds.
+
+    Calls are encoded with `encoding`, either 'json' or 'msgpack'. MessagePack
+    is more compact and can carry bytes, JSON is easier to debug. The session
+    is created on first use, and
+    must be closed with `close()`, or by using the client as an async
+    context manager:
+
+        async with Client(url) as client:
+            await client.method()
+    """
+
+    def __init__(
+        self,
+        base_url,
+        secret=None,
+        max_connections=100,
+        keepalive_timeout=30,
+        encoding='json',
+    ):
         self.base_url = base_url
+        self.target = urlparse(base_url).netloc  # Monitoring label
         self.secret = secret
+        self.content_type = codec.ENCODINGS[encoding]
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._session_loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def session(self):
+        loop = asyncio.get_event_loop()
+        if self._session_loop is not loop:
+            # Sessions cannot be shared between event loops
+            self._close_stale_session()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    def _close_stale_session(self):
+        """Close the session of the previous event loop."""
+        session, loop = self._session, self._session_loop
+        self._session = None
+        if session is None or session.closed:
+            return
+        if loop.is_running():
+            # Used by another thread, close it there
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        elif not loop.is_closed():
+            # Closing the transports does not need their loop to run
+            asyncio.ensure_future(session.close())
+        else:
+            # The connections were dropped along with their loop
+            session.detach()
+
+    async def close(self):
+        """Close the HTTP session and its connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     def _handle_exception(self, data):
         """Handle an exception from a remote call."""
-        raise RemoteError(data['exn_type'], data['exn_message'])
+        raise remote_error(data)
 
     async def _call_method(self, method, args, kwargs):
         """Call the remote `method` passing `args` and `kwargs` to it.
 
-        `args` must be a JSON-serializable list of positional arguments while
-        `kwargs` must be a JSON-serializable dictionary of keyword arguments.
+        `args` must be a serializable list of positional arguments while
+        `kwargs` must be a serializable dictionary of keyword arguments.
 
         Depending on what happens in the remote method, return a result, or
         raise a RemoteError. Raise an InternalError for anything else.
         """
 
-        # Serialize arguments and send the request...
+        return await self._post(
+            'call/{}'.format(method),
+            self._arguments(method, args, kwargs),
+            method,
+        )
+
+    async def batch(self, calls, sequential=False, return_exceptions=False):
+        """Perform several remote calls in a single request.
+
+        `calls` is a list of (method, args) or (method, args, kwargs) tuples.
+        The calls are run concurrently by the server, or in order if
+        `sequential` is set. Return the list of their results, in order.
+
+        If a call raised, raise its RemoteError, or return it in place of
+        its result if `return_exceptions` is set.
+        """
+        batch = []
+        for method, args, *kwargs in calls:
+            call = self._arguments(method, list(args), dict(*kwargs))
+            call['method'] = method
+            batch.append(call)
+
+        results = await self._post(
+            'batch', {'calls': batch, 'sequential': sequential}, 'batch'
+        )
+        if len(results) != len(batch):
+            raise InternalError('Invalid batch result')
+        for i, result in enumerate(results):
+            try:
+                results[i] = self._result_data(result)
+            except RemoteError as e:
+                if not return_exceptions:
+                    raise
+                results[i] = e
+        return results
+
+    def _arguments(self, method, args, kwargs):
         arguments = {
             'args': args,
             'kwargs': kwargs,
@@ -73,42 +213,107 @@ class Client:
             arguments['hmac'] = prologin.timeauth.generate_token(
                 self.secret, method
             )
+        return arguments
+
+    @contextlib.contextmanager
+    def _observe_call(self, method):
+        labels = {'method': method, 'target': self.target}
+        start = time.monotonic()
         try:
-            req_data = json.dumps(arguments)
+            yield labels
+        except RemoteError as e:
+            monitoring.rpc_call_out_errors.labels(error=e.type, **labels).inc()
+            raise
+        except Exception as e:
+            monitoring.rpc_call_out_errors.labels(
+                error=type(e).__name__, **labels
+            ).inc()
+            raise
+        finally:
+            monitoring.rpc_call_out.labels(**labels).observe(
+                time.monotonic() - start
+            )
+
+    async def _post(self, path, arguments, method):
+        try:
+            data = codec.dumps(arguments, self.content_type)
         except (TypeError, ValueError):
             raise ValueError('non serializable argument types')
 
-        url = urljoin(self.base_url, 'call/{}'.format(method))
-        data = '{}\n'.format(req_data).encode('ascii')
-
-        # FIXME(seirl): use a global session and async with?
-        # This would require to have client as a context manager :/
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data) as req:
-                return await self._request_work(req)
+        url = urljoin(self.base_url, path)
+        headers = {
+            'Content-Type': self.content_type,
+            'Accept': self.content_type,
+        }
+        with self._observe_call(method) as labels:
+            monitoring.rpc_call_out_request_bytes.labels(**labels).observe(
+                len(data)
+            )
+            async with self.session.post(
+                url, data=data, headers=headers
+            ) as req:
+                body = await req.read()
+                monitoring.rpc_call_out_response_bytes.labels(
+                    **labels
+                ).observe(len(body))
+                return self._request_work(req, body)
+
+    async def upload(self, path, data):
+        """Stream `data` (bytes or a file object) to `path` with a PUT request.
+
+        This is meant for large binary payloads that should not go through a
+        JSON remote call. The timeauth token is sent in the HMAC_HEADER
+        header, for the given `path`.
+        """
+        headers = {}
+        if self.secret:
+            headers[HMAC_HEADER] = prologin.timeauth.generate_token(
+                self.secret, path
+            )
+        url = urljoin(self.base_url, path)
+        with self._observe_call('upload'):
+            async with self.session.put(
+                url, data=data, headers=headers
+            ) as req:
+                if req.status >= 400:
+                    raise InternalError(
+                        'Upload to {} failed: {} {}'.format(
+                            url, req.status, await req.text()
+                        )
+                    )
 
-    async def _request_work(self, req):
-        if req.headers['Content-Type'] == 'application/json':
+    def _request_work(self, req, body):
+        if req.content_type in (codec.JSON, codec.MSGPACK):
             # The remote call returned: we can have a result or an exception.
-            result = await req.json()
+            try:
+                result = codec.loads(body, req.content_type)
+            except ValueError as e:
+                raise InternalError('Invalid response: {}'.format(e))
+            if req.status == 503 and result.get('exn_type') == 'Overloaded':
+                raise OverloadedError(
+                    result['exn_type'],
+                    result['exn_message'],
+                    float(req.headers.get('Retry-After', 1)),
+                )
+            return self._result_data(result)
+        else:
+            # Something went wrong before reaching the remote procedure...
+            raise InternalError(body.decode(errors='replace'))
 
-            if result['type'] == 'result':
-                # There is nothing more to do than returning the actual
-                # result.
-                return result['data']
+    def _result_data(self, result):
+        if result['type'] == 'result':
+            # There is nothing more to do than returning the actual result.
+            return result['data']
 
-            elif result['type'] == 'exception':
-                # Just raise a RemoteError with interesting data.
-                self._handle_exception(result)
+        elif result['type'] == 'exception':
+            # Just raise a RemoteError with interesting data.
+            self._handle_exception(result)
 
-            else:
-                # There should not be any other possibility.
-                raise InternalError(
-                    'Invalid result type: {}'.format(result['type'])
-                )
         else:
-            # Something went wrong before reaching the remote procedure...
-            raise InternalError(req.text)
+            # There should not be any other possibility.
+            raise InternalError(
+                'Invalid result type: {}'.format(result['type'])
+            )
 
     def __getattr__(self, method):
         """Return a callable to invoke a remote procedure."""
@@ -119,6 +324,9 @@ class Client:
                     return await self._call_method(method, args, kwargs)
                 except socket.error:
                     if i < max_retries:
+                        monitoring.rpc_call_out_retries.labels(
+                            method=method, target=self.target
+                        ).inc()
                         logging.warning(
                             '<%s> down, cannot call %s. ' 'Retrying in %ss...',
                             self.base_url,
@@ -128,22 +336,96 @@ class Client:
                         await asyncio.sleep(retry_delay)
                     else:
                         raise
+                except OverloadedError as e:
+                    if i < max_retries:
+                        monitoring.rpc_call_out_retries.labels(
+                            method=method, target=self.target
+                        ).inc()
+                        logging.warning(
+                            '<%s> overloaded, cannot call %s. '
+                            'Retrying in %ss...',
+                            self.base_url,
+                            method,
+                            e.retry_after,
+                        )
+                        await asyncio.sleep(e.retry_after)
+                    else:
+                        raise
 
         return proxy
 
 
+class _LoopThread:
+    """Event loop running in a daemon thread, shared by the SyncClients."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.clients = weakref.WeakSet()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name='rpc-sync-client', daemon=True
+        )
+        self.thread.start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        if not self.thread.is_alive():  # e.g. in a forked child
+            return
+        for client in list(self.clients):
+            self.run(client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_loop_thread = None
+_loop_thread_lock = threading.Lock()
+
+
+def _get_loop_thread():
+    global _loop_thread
+    with _loop_thread_lock:
+        if _loop_thread is None:
+            _loop_thread = _LoopThread()
+            atexit.register(_loop_thread.stop)
+        return _loop_thread
+
+
+def _reset_loop_thread():
+    # Threads do not survive a fork, the child starts its own loop if needed
+    global _loop_thread, _loop_thread_lock
+    _loop_thread = None
+    _loop_thread_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_loop_thread)
+
+
 class SyncClient(Client):
+    """Blocking RPC client.
+
+    Calls are run on an event loop living in a background thread, shared by
+    all the SyncClients of the process, so that the HTTP session of the
+    client and its connections are reused across calls.
+    """
+
     def __getattr__(self, method):
         coro = super().__getattr__(method)
 
         def proxy(*args, **kwargs):
-            loop = asyncio.new_event_loop()
-            res = loop.run_until_complete(coro(*args, **kwargs))
-            loop.close()
-            return res
+            return self._run(coro(*args, **kwargs))
 
         return proxy
 
+    def batch(self, calls, sequential=False, return_exceptions=False):
+        return self._run(super().batch(calls, sequential, return_exceptions))
+
+    def _run(self, coro):
+        loop_thread = _get_loop_thread()
+        loop_thread.clients.add(self)
+        return loop_thread.run(coro)
+
 
 class MetaClient:
     def __init__(self, client):
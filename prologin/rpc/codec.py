@@ -0,0 +1,55 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Serialization of the RPC requests and responses.
+
+JSON is the default, so that the RPC endpoints can be called with curl.
+MessagePack is more compact, faster to parse, and supports bytes natively:
+a client asks for it by sending its request as MessagePack and by accepting
+it in its Accept header.
+"""
+
+import json
+import msgpack
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Encoding names, as used in the configuration files
+ENCODINGS = {'json': JSON, 'msgpack': MSGPACK}
+
+
+def dumps(data, content_type=JSON) -> bytes:
+    """Serialize `data`, raise a TypeError or a ValueError if it cannot be."""
+    if content_type == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data).encode() + b'\n'
+
+
+def loads(body: bytes, content_type=JSON):
+    """Deserialize `body`, raise a ValueError if it is malformed."""
+    if content_type == MSGPACK:
+        try:
+            # The match players are keyed by their int id
+            return msgpack.unpackb(body, raw=False, strict_map_key=False)
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise ValueError(str(e)) from e
+    return json.loads(body)
+
+
+def accepts_msgpack(accept_header: str) -> bool:
+    return MSGPACK in accept_header
@@ -17,23 +17,61 @@
 
 from functools import wraps
 
-from prometheus_client import Summary
+from prometheus_client import Counter, Histogram, Summary
 
 
 rpc_call_in = Summary(
     'rpc_call_in', 'Summary of the rpc calls received', ['method']
 )
 
+rpc_call_queue_wait = Summary(
+    'rpc_call_queue_wait',
+    'Time spent by the rpc calls received waiting for a free slot',
+    ['method'],
+)
+
+rpc_call_rejected = Counter(
+    'rpc_call_rejected',
+    'Count of the rpc calls received rejected because of overload',
+    ['method'],
+)
+
 
 def _observe_rpc_call_in(f):
     @wraps(f)
-    async def _wrapper(self):
+    async def _wrapper(self, *args, **kwargs):
         with rpc_call_in.labels(method=self.method_name).time():
-            return await f(self)
+            return await f(self, *args, **kwargs)
 
     return _wrapper
 
 
-rpc_call_out = Summary('rpc_call_out', 'Summary of the rpc calls sent')
+rpc_call_out = Histogram(
+    'rpc_call_out', 'Histogram of the rpc calls sent', ['method', 'target']
+)
+
+rpc_call_out_request_bytes = Summary(
+    'rpc_call_out_request_bytes',
+    'Size of the requests of the rpc calls sent',
+    ['method', 'target'],
+)
+
+rpc_call_out_response_bytes = Summary(
+    'rpc_call_out_response_bytes',
+    'Size of the responses of the rpc calls sent',
+    ['method', 'target'],
+)
+
+rpc_call_out_retries = Counter(
+    'rpc_call_out_retries',
+    'Count of the retries of the rpc calls sent',
+    ['method', 'target'],
+)
+
+rpc_call_out_errors = Counter(
+    'rpc_call_out_errors',
+    'Count of the rpc calls sent that failed, by error type',
+    ['method', 'target', 'error'],
+)
 
 # Monitoring is started by the application using the rpc library
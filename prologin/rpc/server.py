@@ -12,16 +12,16 @@
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
 import aiohttp.web
+import asyncio
 import functools
 import inspect
-import json
 import logging
 import sys
 import traceback
 
 import prologin.timeauth
 import prologin.web
-from prologin.rpc import monitoring
+from prologin.rpc import codec, monitoring
 
 
 class MethodError(Exception):
@@ -32,6 +32,14 @@ class MethodError(Exception):
     pass
 
 
+class Overloaded(Exception):
+    """Exception used to notice the remote callers that the requested method
+    has too many calls in progress, and that they should retry later.
+    """
+
+    pass
+
+
 class BadToken(Exception):
     """Exception used to notice the remote callers that the timeauth token
     is wrong or has expired.
@@ -48,12 +56,34 @@ class MissingToken(Exception):
     pass
 
 
-def remote_method(func=None, *, auth_required=True):
-    """Decorator for methods to be callable remotely."""
+def remote_method(
+    func=None,
+    *,
+    auth_required=True,
+    max_concurrency=None,
+    max_queue=0,
+    retry_after=1,
+):
+    """Decorator for methods to be callable remotely.
+
+    If `max_concurrency` is set, at most this number of calls of the method
+    run at the same time, and at most `max_queue` calls wait for their turn.
+    Other calls are rejected with a 503 error, and asked to retry after
+    `retry_after` seconds.
+    """
     if func is None:
-        return functools.partial(remote_method, auth_required=auth_required)
+        return functools.partial(
+            remote_method,
+            auth_required=auth_required,
+            max_concurrency=max_concurrency,
+            max_queue=max_queue,
+            retry_after=retry_after,
+        )
     func.remote_method = True
     func.auth_required = auth_required
+    func.max_concurrency = max_concurrency
+    func.max_queue = max_queue
+    func.retry_after = retry_after
     return func
 
 
@@ -83,39 +113,110 @@ class MethodCollection(type):
         cls.REMOTE_METHODS = remote_methods
 
 
+class ConcurrencyLimit:
+    """Bound the number of concurrent calls of a remote method."""
+
+    def __init__(self, max_concurrency, max_queue):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.waiting = 0
+
+    def full(self):
+        return self.semaphore.locked() and self.waiting >= self.max_queue
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+
+class ErrorResponse(Exception):
+    """Failure of a remote call, answered with `response`."""
+
+    def __init__(self, response):
+        super().__init__(response.status)
+        self.response = response
+
+
 class RemoteCallHandler:
-    def __init__(self, request):
+    def __init__(self, request, method_name=None):
         self.request = request
-        self.secret = self.request.app.secret
-        self.method_name = request.match_info['name']
+        self.app = request.app
+        self.secret = self.app.secret
+        self.method_name = method_name or request.match_info['name']
+        self.peername = None
+        if request.transport is not None:
+            self.peername = request.transport.get_extra_info('peername')
+        # Answer in the encoding of the request if the client accepts it
+        self.content_type = codec.JSON
+        if request.content_type == codec.MSGPACK and codec.accepts_msgpack(
+            request.headers.get('Accept', '')
+        ):
+            self.content_type = codec.MSGPACK
 
     @property
     def rpc_object(self):
         """RPC object: contains method that can be called remotely."""
-        return self.request.app.rpc_object
+        return self.app.rpc_object
 
-    @monitoring._observe_rpc_call_in
     async def __call__(self):
         data = {'args': [], 'kwargs': {}}
         if self.request.method == 'POST':
-            try:
-                data.update(await self.request.json())
-            except json.decoder.JSONDecodeError as exn:
-                self._raise_exception(exn)
+            data.update(await self._read_data())
+        result = await self._process(data)
+        return await self._send_result_data(result)
 
+    async def _read_data(self):
+        request_type = codec.JSON
+        if self.request.content_type == codec.MSGPACK:
+            request_type = codec.MSGPACK
+        try:
+            return codec.loads(await self.request.read(), request_type)
+        except ValueError as exn:
+            self._raise_exception(exn)
+
+    @monitoring._observe_rpc_call_in
+    async def _process(self, data):
         self._log_call(data)
 
         method = await self._get_method()
         if method.auth_required:
             await self._check_secret(data)
 
-        result = await self._call_method(method, data)
+        if method.max_concurrency is None:
+            return await self._call_method(method, data)
 
-        return await self._send_result_data(result)
+        limit = self._get_limit(method)
+        if limit.full():
+            monitoring.rpc_call_rejected.labels(method=self.method_name).inc()
+            self._raise_exception(
+                Overloaded(self.method_name),
+                http_error=aiohttp.web.HTTPServiceUnavailable,
+                headers={'Retry-After': str(method.retry_after)},
+            )
+        with monitoring.rpc_call_queue_wait.labels(
+            method=self.method_name
+        ).time():
+            await limit.acquire()
+        try:
+            return await self._call_method(method, data)
+        finally:
+            limit.release()
+
+    def _get_limit(self, method):
+        limits = self.app.rpc_limits
+        if self.method_name not in limits:
+            limits[self.method_name] = ConcurrencyLimit(
+                method.max_concurrency, method.max_queue
+            )
+        return limits[self.method_name]
 
     def _log_call(self, data):
-        peername = self.request.transport.get_extra_info('peername')
-
         def farg(a):
             if isinstance(a, str) and len(a) > 10:
                 a = a[:10] + '…'
@@ -123,7 +224,7 @@ class RemoteCallHandler:
 
         logging.debug(
             'RPC <%s> %s(%s%s)',
-            peername,
+            self.peername,
             self.method_name,
             ', '.join(farg(a) for a in data['args']),
             ', '.join(
@@ -168,33 +269,125 @@ class RemoteCallHandler:
             tb = sys.exc_info()[2]
             self._raise_exception(exn, tb)
 
-    async def _send_json(self, data):
+    async def _send_data(self, data):
         return aiohttp.web.Response(
-            body=json.dumps(data).encode() + b'\n',
-            content_type='application/json',
+            body=codec.dumps(data, self.content_type),
+            content_type=self.content_type,
         )
 
-    def _raise_exception(
-        self, exn, tb=None, http_error=aiohttp.web.HTTPInternalServerError
-    ):
-        data = {
+    @staticmethod
+    def _exception_data(exn, tb=None):
+        return {
             'type': 'exception',
             'exn_type': type(exn).__name__,
             'exn_message': str(exn),
             'exn_traceback': traceback.format_tb(tb),
         }
-        body = json.dumps(data).encode() + b'\n'
-        raise http_error(body=body, content_type='application/json')
+
+    def _raise_exception(
+        self,
+        exn,
+        tb=None,
+        http_error=aiohttp.web.HTTPInternalServerError,
+        headers=None,
+    ):
+        # aiohttp re-encodes the HTTP exceptions raised by the handlers as
+        # text, which a MessagePack body is not: answer with a response.
+        raise ErrorResponse(
+            aiohttp.web.Response(
+                status=http_error.status_code,
+                body=codec.dumps(
+                    self._exception_data(exn, tb), self.content_type
+                ),
+                content_type=self.content_type,
+                headers=headers,
+            )
+        )
 
     async def _send_result_data(self, data):
         try:
-            return await self._send_json({'type': 'result', 'data': data})
+            return await self._send_data({'type': 'result', 'data': data})
         except (TypeError, ValueError):
             self._raise_exception(
-                ValueError('The remote method returned something not JSON'),
+                ValueError(
+                    'The remote method returned something not serializable'
+                ),
             )
 
 
+class BatchedCallError(Exception):
+    """Error of a call of a batch, reported in the results of the batch."""
+
+    def __init__(self, data):
+        super().__init__(data['exn_type'], data['exn_message'])
+        self.data = data
+
+
+class BatchedCallHandler(RemoteCallHandler):
+    """Handle one of the calls of a batch, without failing the whole batch
+    when it raises.
+    """
+
+    def _raise_exception(self, exn, tb=None, http_error=None, headers=None):
+        data = self._exception_data(exn, tb)
+        if headers and 'Retry-After' in headers:
+            # There is no header for each call, the delay goes in the reply
+            data['retry_after'] = float(headers['Retry-After'])
+        raise BatchedCallError(data)
+
+    async def result(self, data):
+        try:
+            return {'type': 'result', 'data': await self._process(data)}
+        except BatchedCallError as e:
+            return e.data
+
+
+class BatchHandler(RemoteCallHandler):
+    """Perform a list of remote calls received in a single request.
+
+    The request contains {'calls': [call, ...], 'sequential': bool}, each
+    call being {'method': name, 'args': [...], 'kwargs': {...}, 'hmac':
+    token}. The calls are run concurrently, or one after the other if
+    `sequential` is set. The result is the list of the results of the
+    calls, in order, each in the format of a single remote call response.
+    """
+
+    def __init__(self, request):
+        super().__init__(request, method_name='batch')
+
+    async def __call__(self):
+        batch = await self._read_data()
+        try:
+            calls = [
+                (str(call['method']), self._call_data(call))
+                for call in batch['calls']
+            ]
+        except (AttributeError, KeyError, TypeError) as exn:
+            self._raise_exception(
+                ValueError('Malformed batch: {}'.format(exn)),
+                http_error=aiohttp.web.HTTPBadRequest,
+            )
+
+        if batch.get('sequential', False):
+            results = [await self._run_call(*call) for call in calls]
+        else:
+            results = await asyncio.gather(
+                *(self._run_call(*call) for call in calls)
+            )
+        return await self._send_result_data(results)
+
+    @staticmethod
+    def _call_data(call):
+        return {
+            'args': call.get('args', []),
+            'kwargs': call.get('kwargs', {}),
+            'hmac': call.get('hmac'),
+        }
+
+    async def _run_call(self, method_name, data):
+        return await BatchedCallHandler(self.request, method_name).result(data)
+
+
 class BaseRPCApp(prologin.web.AiohttpApp, metaclass=MethodCollection):
     """RPC base application: let clients call remotely subclasses methods.
 
@@ -204,13 +397,34 @@ class BaseRPCApp(prologin.web.AiohttpApp, metaclass=MethodCollection):
 
     def __init__(self, app_name, secret=None, **kwargs):
         async def handler(request):
-            return await RemoteCallHandler(request)()
+            try:
+                return await RemoteCallHandler(request)()
+            except ErrorResponse as e:
+                return e.response
+
+        async def batch_handler(request):
+            try:
+                return await BatchHandler(request)()
+            except ErrorResponse as e:
+                return e.response
 
         super().__init__(
-            [('*', r'/call/{name:[0-9a-zA-Z_]+}', handler)],
+            [
+                ('*', r'/call/{name:[0-9a-zA-Z_]+}', handler),
+                ('POST', r'/batch', batch_handler),
+            ],
             app_name,
             client_max_size=1024 * 1024 * 1024 * 1,
             **kwargs,
         )
         self.app.secret = secret
         self.app.rpc_object = self
+        self.app.rpc_limits = {}  # method name -> ConcurrencyLimit
+
+    async def channel_opened(self, peer, request):
+        """Called when a WebSocket channel is opened, see rpc.websocket."""
+        pass
+
+    async def channel_closed(self, peer, request):
+        """Called when a WebSocket channel is closed, see rpc.websocket."""
+        pass
@@ -0,0 +1,261 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bidirectional RPC channels over WebSocket.
+
+A client opens a channel to a server with `connect()`, the server accepting
+it with the `handle_channel` route. Both ends can then call the remote
+methods of the other one on the same connection, without establishing a
+connection per call, and both are notified as soon as the connection drops.
+
+Frames are dicts encoded like regular remote calls:
+
+- calls: {'call': id, 'method': name, 'args': [...], 'kwargs': {...},
+  'hmac': token}
+- replies: {'reply': id} plus the response of a regular remote call.
+"""
+
+import aiohttp
+import aiohttp.web
+import asyncio
+import contextlib
+import itertools
+import logging
+import yarl
+
+import prologin.timeauth
+from prologin.rpc import codec
+from prologin.rpc.client import HMAC_HEADER, remote_error
+from prologin.rpc.server import BatchedCallHandler
+
+# Interval of the WebSocket pings, a peer not answering them is disconnected
+HEARTBEAT_SECS = 5
+# Name the connection token is generated for
+CHANNEL_TOKEN = 'ws'
+
+
+class WebSocketCallHandler(BatchedCallHandler):
+    """Handle a call received on a channel."""
+
+    def __init__(self, app, peername, method_name):
+        self.request = None
+        self.app = app
+        self.secret = app.secret
+        self.method_name = method_name
+        self.peername = peername
+        self.content_type = codec.JSON
+
+
+class WebSocketPeer:
+    """The other end of a channel.
+
+    Remote methods of the peer are called like with a Client, calls from
+    the peer are served by the RPC object of `app`.
+    """
+
+    def __init__(self, ws, app, peername, secret=None, content_type=None):
+        self.ws = ws
+        self.app = app
+        self.peername = peername
+        self.secret = secret
+        self.content_type = content_type or codec.JSON
+        self.pending = {}  # call id -> future of the reply
+        self.ids = itertools.count()
+        self.handlers = set()
+
+    @property
+    def closed(self):
+        return self.ws.closed
+
+    async def close(self):
+        await self.ws.close()
+
+    async def call(self, method, args, kwargs):
+        if self.ws.closed:
+            raise ConnectionResetError('channel to {} closed'.format(self))
+        call_id = next(self.ids)
+        frame = {
+            'call': call_id,
+            'method': method,
+            'args': list(args),
+            'kwargs': kwargs,
+        }
+        if self.secret:
+            frame['hmac'] = prologin.timeauth.generate_token(
+                self.secret, method
+            )
+        try:
+            data = codec.dumps(frame, self.content_type)
+        except (TypeError, ValueError):
+            raise ValueError('non serializable argument types')
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending[call_id] = future
+        try:
+            await self.ws.send_bytes(data)
+            return await future
+        finally:
+            del self.pending[call_id]
+
+    def __getattr__(self, method):
+        """Return a callable to invoke a remote procedure of the peer."""
+
+        async def proxy(*args, max_retries=0, retry_delay=10, **kwargs):
+            # The channel is not retried, callers fall back to a Client
+            return await self.call(method, args, kwargs)
+
+        return proxy
+
+    async def run(self):
+        """Serve the channel until it is closed."""
+        try:
+            async for msg in self.ws:
+                if msg.type == aiohttp.WSMsgType.BINARY:
+                    data = msg.data
+                elif msg.type == aiohttp.WSMsgType.TEXT:
+                    data = msg.data.encode()
+                else:
+                    break
+                try:
+                    frame = codec.loads(data, self.content_type)
+                    if 'reply' in frame:
+                        self.on_reply(frame)
+                    elif 'call' in frame and 'method' in frame:
+                        handler = asyncio.ensure_future(self.on_call(frame))
+                        self.handlers.add(handler)
+                        handler.add_done_callback(self.handlers.discard)
+                    else:
+                        raise ValueError(frame)
+                except (ValueError, TypeError, KeyError):
+                    logging.warning('invalid frame from %s', self)
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionResetError(
+                            'channel to {} closed'.format(self)
+                        )
+                    )
+            for handler in list(self.handlers):
+                handler.cancel()
+
+    def on_reply(self, frame):
+        future = self.pending.get(frame['reply'])
+        if future is None or future.done():
+            return
+        if frame['type'] == 'result':
+            future.set_result(frame['data'])
+        else:
+            future.set_exception(remote_error(frame))
+
+    async def on_call(self, frame):
+        handler = WebSocketCallHandler(
+            self.app, self.peername, str(frame['method'])
+        )
+        reply = await handler.result(
+            {
+                'args': frame.get('args', []),
+                'kwargs': frame.get('kwargs', {}),
+                'hmac': frame.get('hmac'),
+            }
+        )
+        reply['reply'] = frame['call']
+        try:
+            data = codec.dumps(reply, self.content_type)
+        except (TypeError, ValueError):
+            data = codec.dumps(
+                {
+                    'reply': frame['call'],
+                    **handler._exception_data(
+                        ValueError(
+                            'The remote method returned something not '
+                            'serializable'
+                        )
+                    ),
+                },
+                self.content_type,
+            )
+        if not self.ws.closed:
+            await self.ws.send_bytes(data)
+
+    def __repr__(self):
+        return '<WebSocketPeer: {}>'.format(self.peername)
+
+
+async def handle_channel(request):
+    """Accept a channel, and serve it until it is closed.
+
+    The `channel_opened` and `channel_closed` methods of the RPC object are
+    called with the peer and the request when the channel is opened and
+    closed.
+    """
+    app = request.app
+    if app.secret is not None and not prologin.timeauth.check_token(
+        request.headers.get(HMAC_HEADER), app.secret, CHANNEL_TOKEN
+    ):
+        raise aiohttp.web.HTTPForbidden()
+
+    ws = aiohttp.web.WebSocketResponse(
+        heartbeat=HEARTBEAT_SECS, max_msg_size=0
+    )
+    await ws.prepare(request)
+    content_type = codec.ENCODINGS.get(
+        request.query.get('encoding'), codec.JSON
+    )
+    peer = WebSocketPeer(
+        ws,
+        app,
+        request.transport.get_extra_info('peername'),
+        secret=app.secret,
+        content_type=content_type,
+    )
+    await app.rpc_object.channel_opened(peer, request)
+    try:
+        await peer.run()
+    finally:
+        await app.rpc_object.channel_closed(peer, request)
+    return ws
+
+
+@contextlib.asynccontextmanager
+async def connect(client, app, params=None):
+    """Open a channel to the server of `client`.
+
+    The calls of the server are served by the RPC object of `app`. `params`
+    are sent to the server in the query string.
+    """
+    headers = {}
+    if client.secret:
+        headers[HMAC_HEADER] = prologin.timeauth.generate_token(
+            client.secret, CHANNEL_TOKEN
+        )
+    encoding = 'msgpack' if client.content_type == codec.MSGPACK else 'json'
+    params = dict(params or {}, encoding=encoding)
+    url = yarl.URL(client.base_url.rstrip('/') + '/ws').with_query(params)
+    async with client.session.ws_connect(
+        url,
+        headers=headers,
+        heartbeat=HEARTBEAT_SECS,
+        max_msg_size=0,
+    ) as ws:
+        yield WebSocketPeer(
+            ws,
+            app,
+            client.target,
+            secret=client.secret,
+            content_type=client.content_type,
+        )
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import asyncio
+import pytest
+
+from prologin.masternode.artifacts import ArtifactWriter
+
+
+@pytest.fixture
+async def artifact_writer():
+    writer = ArtifactWriter(writers=2, queue_size=1)
+    writer.start()
+    yield writer
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    writer.executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_write(artifact_writer, tmp_path):
+    await artifact_writer.write(
+        {tmp_path / 'log': 'compilation log', tmp_path / 'tgz': b'\x1f\x8b'}
+    )
+    assert (tmp_path / 'log').read_text() == 'compilation log'
+    assert (tmp_path / 'tgz').read_bytes() == b'\x1f\x8b'
+
+
+@pytest.mark.asyncio
+async def test_write_error(artifact_writer, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        await artifact_writer.write({tmp_path / 'missing' / 'log': 'log'})
+    # The writers survive the failed job
+    await artifact_writer.write({tmp_path / 'log': 'log'})
+    assert (tmp_path / 'log').read_text() == 'log'
+
+
+@pytest.mark.asyncio
+async def test_write_concurrent(artifact_writer, tmp_path):
+    # More writes than writers and queue spots
+    await asyncio.gather(
+        *(
+            artifact_writer.write({tmp_path / str(i): str(i)})
+            for i in range(10)
+        )
+    )
+    assert sorted(p.read_text() for p in tmp_path.iterdir()) == sorted(
+        str(i) for i in range(10)
+    )
+
+
+class Stream:
+    """Stand-in for an aiohttp StreamReader."""
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            assert len(chunk) <= size
+            yield chunk
+            await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.mark.asyncio
+async def test_write_stream(artifact_writer, tmp_path):
+    path = tmp_path / 'replay.gz'
+    await artifact_writer.write_stream(
+        path, Stream([b'abc', b'def']), chunk_size=3
+    )
+    assert path.read_bytes() == b'abcdef'
+    assert list(tmp_path.iterdir()) == [path]
+
+
+@pytest.mark.asyncio
+async def test_write_stream_interrupted(artifact_writer, tmp_path):
+    path = tmp_path / 'replay.gz'
+    stream = Stream([b'abc'], error=ConnectionResetError())
+    with pytest.raises(ConnectionResetError):
+        await artifact_writer.write_stream(path, stream)
+    # No partial artifact is left behind
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_slow_streams_do_not_block_writes(artifact_writer, tmp_path):
+    received = asyncio.Event()
+
+    class SlowStream:
+        async def iter_chunked(self, size):
+            yield b'abc'
+            await received.wait()
+            yield b'def'
+
+    streams = [
+        asyncio.ensure_future(
+            artifact_writer.write_stream(tmp_path / str(i), SlowStream())
+        )
+        for i in range(artifact_writer.writers + 1)
+    ]
+    await asyncio.wait_for(artifact_writer.write({tmp_path / 'log': 'log'}), 1)
+    received.set()
+    await asyncio.gather(*streams)
+    assert (tmp_path / '0').read_bytes() == b'abcdef'
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import hashlib
+import pytest
+
+from prologin.masternode.cache import ChampionCache, CompilationCache
+
+
+@pytest.mark.asyncio
+async def test_champion_cache(tmp_path):
+    path = tmp_path / 'champion-compiled.tgz'
+    path.write_bytes(b'champion')
+    cache = ChampionCache(max_size=1024)
+    digest = await cache.get_hash(1, path)
+    assert digest == hashlib.sha256(b'champion').hexdigest()
+    assert await cache.get_hash(1, path) == digest
+    assert await cache.get(digest) == 'Y2hhbXBpb24='
+    with pytest.raises(KeyError):
+        await cache.get('unknown')
+
+
+@pytest.mark.asyncio
+async def test_champion_cache_recompiled(tmp_path):
+    path = tmp_path / 'champion-compiled.tgz'
+    other_path = tmp_path / 'other-compiled.tgz'
+    path.write_bytes(b'champion')
+    other_path.write_bytes(b'champion')
+    cache = ChampionCache(max_size=0)  # Nothing kept in memory
+    digest = await cache.get_hash(1, path)
+    assert await cache.get_hash(2, other_path) == digest
+
+    path.write_bytes(b'recompiled')
+    new_digest = await cache.get_hash(1, path)
+    assert new_digest == hashlib.sha256(b'recompiled').hexdigest()
+    assert set(cache.digests) == {1, 2}
+    # Still the hash of the other champion
+    assert cache.paths[digest] == other_path
+
+    other_path.write_bytes(b'recompiled too')
+    await cache.get_hash(2, other_path)
+    assert digest not in cache.paths
+    with pytest.raises(KeyError):
+        await cache.get(digest)
+
+
+def test_champion_cache_eviction(tmp_path):
+    cache = ChampionCache(max_size=10)
+    cache.put('a', '12345')
+    cache.put('b', '12345')
+    cache.put('c', '12345')
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.size == 10
+
+
+def test_compilation_cache(tmp_path):
+    cache = CompilationCache(tmp_path, toolchain_version=1)
+    assert cache.get('digest') is None
+    files = {'compilation.log': 'log', 'champion-compiled.tgz': b'tgz'}
+    cache.put('digest', 'ready', files)
+    assert cache.get('digest') == (
+        'ready',
+        {'compilation.log': b'log', 'champion-compiled.tgz': b'tgz'},
+    )
+    # The first result is kept
+    cache.put('digest', 'error', {'compilation.log': 'other'})
+    assert cache.get('digest')[0] == 'ready'
+
+
+def test_compilation_cache_status(tmp_path):
+    cache = CompilationCache(tmp_path)
+    # A successful compilation that produced no tarball stays ready
+    cache.put('digest', 'ready', {'compilation.log': 'log'})
+    assert cache.get('digest') == ('ready', {'compilation.log': b'log'})
+
+
+def test_compilation_cache_toolchain_version(tmp_path):
+    CompilationCache(tmp_path, 1).put('digest', 'ready', {'log': 'log'})
+    assert CompilationCache(tmp_path, 2).get('digest') is None
+
+
+def test_compilation_cache_disabled():
+    assert not CompilationCache(None).enabled
+    assert CompilationCache('/tmp').enabled
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import asyncio
+import pytest
+import time
+
+from prologin.masternode.deadlines import Deadlines
+
+
+@pytest.mark.asyncio
+async def test_pop_expired():
+    deadlines = Deadlines()
+    now = time.monotonic()
+    deadlines.schedule(now + 60, 'later')
+    deadlines.schedule(now - 1, 'second')
+    deadlines.schedule(now - 2, 'first')
+    assert deadlines.pop_expired() == ['first', 'second']
+    assert deadlines.pop_expired() == []
+    assert len(deadlines) == 1
+
+
+@pytest.mark.asyncio
+async def test_same_deadline():
+    deadlines = Deadlines()
+    now = time.monotonic()
+    # The items themselves are never compared
+    deadlines.schedule(now, {'a': 1})
+    deadlines.schedule(now, {'b': 2})
+    assert deadlines.pop_expired() == [{'a': 1}, {'b': 2}]
+
+
+@pytest.mark.asyncio
+async def test_wait_until_deadline():
+    deadlines = Deadlines()
+    deadlines.schedule(time.monotonic() + 0.1, 'item')
+    await asyncio.wait_for(deadlines.wait(), 1)
+    assert deadlines.pop_expired() == ['item']
+
+
+@pytest.mark.asyncio
+async def test_wait_earlier_deadline():
+    deadlines = Deadlines()
+    deadlines.schedule(time.monotonic() + 60, 'later')
+    waiter = asyncio.ensure_future(deadlines.wait())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    # The waiter wakes up to sleep until the new earliest deadline
+    deadlines.schedule(time.monotonic(), 'now')
+    await asyncio.wait_for(waiter, 1)
+    assert deadlines.pop_expired() == ['now']
+
+
+@pytest.mark.asyncio
+async def test_wait_empty():
+    deadlines = Deadlines()
+    waiter = asyncio.ensure_future(deadlines.wait())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    deadlines.schedule(time.monotonic() + 60, 'item')
+    await asyncio.wait_for(waiter, 1)
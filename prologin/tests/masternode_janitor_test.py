@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import asyncio
+import copy
+import pytest
+
+import prologin.config
+from prologin.masternode.master import MasterNode
+from prologin.masternode.task import Task
+
+TIMEOUT = 0.3
+RETRY_DELAY = 0.05
+
+
+class FakeTask(Task):
+    KIND = 'fake'
+    BATCH_KEY = 'fakes'
+
+    def __init__(self):
+        super().__init__(timeout=TIMEOUT)
+
+    @property
+    def slots_taken(self):
+        return 1
+
+    @property
+    def key(self):
+        return (self.KIND, 1)
+
+    def batch_args(self):
+        return []
+
+    async def execute(self, master, worker):
+        # Sent to the worker, which never answers
+        await self.prepare()
+
+    async def redispatch(self):
+        pass
+
+    async def fail(self):
+        pass
+
+
+class FakeWorker:
+    def __init__(self, task):
+        self.tasks = {task.key: task}
+
+    def get_task(self, key):
+        return self.tasks.get(key)
+
+
+@pytest.fixture
+def master():
+    config = copy.deepcopy(prologin.config.load('masternode'))
+    config['worker']['retry_delay_secs'] = RETRY_DELAY
+    config['worker']['max_task_tries'] = 10
+    return MasterNode(app_name='masternode', config=config)
+
+
+@pytest.mark.asyncio
+async def test_failed_dispatch_then_timeout(master):
+    task = FakeTask()
+    worker = FakeWorker(task)
+    await task.prepare()
+    master.schedule_task(worker, task)
+    # The dispatch fails, the task is retried after RETRY_DELAY
+    task.error = 'Could not send task'
+    master.schedule_task(worker, task)
+
+    janitor = asyncio.ensure_future(master.janitor_task())
+    try:
+        # Retried once after RETRY_DELAY, then once more after its timeout
+        await asyncio.sleep(RETRY_DELAY + TIMEOUT + 0.15)
+    finally:
+        janitor.cancel()
+        await asyncio.gather(janitor, return_exceptions=True)
+    assert task.executions == 3
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import prologin.masternode.journal
+from prologin.masternode.journal import TaskJournal
+
+
+def test_journal(tmp_path):
+    path = tmp_path / 'journal'
+    journal = TaskJournal(path)
+    assert journal.load() == {}
+    journal.open({})
+    journal.add(('match', 1), 'worker1', 8068, 100)
+    journal.add(('compilation', 2), 'worker2', 8068, 200)
+    journal.remove(('match', 1))
+    journal.file.close()
+
+    assert TaskJournal(path).load() == {
+        ('compilation', 2): ('worker2', 8068, 200)
+    }
+
+
+def test_journal_compaction(tmp_path):
+    path = tmp_path / 'journal'
+    journal = TaskJournal(path)
+    journal.open({})
+    for i in range(10):
+        journal.add(('match', i), 'worker', 8068, i)
+        journal.remove(('match', i))
+    journal.add(('match', 42), 'worker', 8068, 42)
+    journal.file.close()
+
+    journal = TaskJournal(path)
+    entries = journal.load()
+    journal.open(entries)
+    journal.file.close()
+    assert path.read_text().splitlines() == [
+        '["add", "match", 42, "worker", 8068, 42]'
+    ]
+    assert TaskJournal(path).load() == entries
+
+
+def test_journal_auto_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(prologin.masternode.journal, 'COMPACT_MIN_RECORDS', 4)
+    path = tmp_path / 'journal'
+    journal = TaskJournal(path)
+    journal.open({('match', 1): ('worker', 8068, 1)})
+    for i in range(2, 10):
+        journal.add(('match', i), 'worker', 8068, i)
+        journal.remove(('match', i))
+        # Never much more than twice the running tasks
+        assert len(path.read_text().splitlines()) <= 4
+    journal.add(('match', 42), 'worker', 8068, 42)
+    journal.file.close()
+
+    assert TaskJournal(path).load() == {
+        ('match', 1): ('worker', 8068, 1),
+        ('match', 42): ('worker', 8068, 42),
+    }
+
+
+def test_journal_bad_lines(tmp_path):
+    path = tmp_path / 'journal'
+    path.write_text(
+        '["add", "match", 1, "worker", 8068, 100]\n'
+        '["add", "match"]\n'
+        '["add", "match", 2, "work'  # Truncated by a crash
+    )
+    assert TaskJournal(path).load() == {('match', 1): ('worker', 8068, 100)}
+
+
+def test_journal_disabled():
+    journal = TaskJournal(None)
+    assert journal.load() == {}
+    journal.open({('match', 1): ('worker', 8068, 100)})
+    journal.add(('match', 2), 'worker', 8068, 100)
+    journal.remove(('match', 1))
+    assert journal.file is None
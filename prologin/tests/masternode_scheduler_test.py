@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import collections
+import pytest
+
+from prologin.masternode.scheduler import FairShare, Scheduler
+
+Task = collections.namedtuple('Task', 'author priority id')
+Worker = collections.namedtuple('Worker', 'name slots')
+
+
+def tasks_of(author, count, priority=0):
+    return [Task(author, priority, i) for i in range(count)]
+
+
+def dispatch(fair_share, tasks, count=None):
+    """Dispatch the first `count` tasks in fair order, charging them."""
+    dispatched = []
+    for task in fair_share.order(tasks):
+        if count is not None and len(dispatched) >= count:
+            break
+        fair_share.charge(task)
+        dispatched.append(task)
+    return dispatched
+
+
+def test_scheduler_policies():
+    workers = [Worker('a', 1), Worker('b', 3), Worker('c', 5)]
+    for policy, expected in (('spread', 'c'), ('pack', 'b')):
+        scheduler = Scheduler(policy)
+        for worker in workers:
+            scheduler.add(worker)
+        assert scheduler.find(2).name == expected
+        assert scheduler.find(6) is None
+        assert scheduler.capacity(2) == 3
+
+
+def test_scheduler_update():
+    scheduler = Scheduler()
+    worker = Worker('a', 5)
+    scheduler.add(worker)
+    scheduler.remove(worker)
+    assert len(scheduler) == 0
+    assert scheduler.find(1) is None
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Scheduler('random')
+
+
+def test_fair_share_round_robin():
+    fair_share = FairShare()
+    tasks = tasks_of('alice', 3) + tasks_of('bob', 3)
+    authors = [t.author for t in dispatch(fair_share, tasks)]
+    assert authors == ['alice', 'bob'] * 3
+
+
+def test_fair_share_weights():
+    fair_share = FairShare({'alice': 2})
+    tasks = tasks_of('alice', 4) + tasks_of('bob', 2)
+    authors = [t.author for t in dispatch(fair_share, tasks)]
+    assert authors == ['alice', 'alice', 'bob'] * 2
+
+
+def test_fair_share_priority():
+    fair_share = FairShare()
+    tasks = tasks_of('alice', 2) + tasks_of('bob', 1, priority=1)
+    authors = [t.author for t in dispatch(fair_share, tasks)]
+    assert authors == ['bob', 'alice', 'alice']
+
+
+def test_fair_share_turns_kept():
+    fair_share = FairShare()
+    tasks = tasks_of('alice', 3) + tasks_of('bob', 3)
+    assert [t.author for t in dispatch(fair_share, tasks, 1)] == ['alice']
+    # Bob gets the next free slot, even though alice comes first
+    assert [t.author for t in dispatch(fair_share, tasks, 1)] == ['bob']
+
+
+def test_fair_share_skipped_tasks_not_charged():
+    fair_share = FairShare()
+    tasks = tasks_of('alice', 3) + tasks_of('bob', 3)
+    # The consumer stops without dispatching what it was given
+    for task in fair_share.order(tasks):
+        break
+    assert [t.author for t in dispatch(fair_share, tasks, 2)] == [
+        'alice',
+        'bob',
+    ]
+
+
+@pytest.mark.parametrize('weights', [{'alice': 0}, {'bob': -1}])
+def test_fair_share_non_positive_weight(weights):
+    with pytest.raises(ValueError):
+        FairShare(weights)
+    with pytest.raises(ValueError):
+        FairShare(default_weight=0)
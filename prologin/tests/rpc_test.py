@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
 import aiohttp.test_utils
+import asyncio
 import contextlib
 import logging
 import pytest
 
 import prologin.rpc.client
 import prologin.rpc.server
+import prologin.rpc.websocket
 
 
 @contextlib.contextmanager
@@ -48,12 +50,20 @@ class RPCServer(prologin.rpc.server.BaseRPCApp):
     async def public_hello(self):
         return 'hello'
 
+    @prologin.rpc.remote_method(max_concurrency=1, max_queue=1, retry_after=2)
+    async def limited_sleep(self, secs):
+        await asyncio.sleep(secs)
+        return secs
+
 
 class RPCServerInstance:
     def __init__(self, *, port, secret=None):
         self.port = port
         self.secret = secret
         self.app = RPCServer('test-rpc', secret=self.secret)
+        self.app.app.router.add_route(
+            'GET', '/ws', prologin.rpc.websocket.handle_channel
+        )
         self.runner = None
 
     async def start(self):
@@ -91,7 +101,8 @@ def with_secret(secret):
 
 @pytest.fixture
 async def rpc_client(rpc_server):
-    return prologin.rpc.client.Client(rpc_server)
+    async with prologin.rpc.client.Client(rpc_server) as client:
+        yield client
 
 
 @pytest.mark.asyncio
@@ -136,6 +147,151 @@ async def test_raises_valueerror(rpc_client):
     assert e.value.message == 'Monde de merde.'
 
 
+@pytest.mark.asyncio
+async def test_session_reused(rpc_server):
+    async with prologin.rpc.client.Client(rpc_server) as rpc_client:
+        assert (await rpc_client.return_number()) == 42
+        session = rpc_client.session
+        assert (await rpc_client.return_string()) == 'prologin'
+        assert rpc_client.session is session
+    assert session.closed
+
+
+def test_session_loop_change():
+    rpc_client = prologin.rpc.client.Client('http://127.0.0.1:1')
+
+    async def get_session():
+        session = rpc_client.session
+        await asyncio.sleep(0)  # Let the stale session close
+        return session
+
+    first_loop = asyncio.new_event_loop()
+    second_loop = asyncio.new_event_loop()
+    try:
+        first = first_loop.run_until_complete(get_session())
+        second = second_loop.run_until_complete(get_session())
+        assert first is not second
+        assert first.closed
+        second_loop.run_until_complete(rpc_client.close())
+    finally:
+        first_loop.close()
+        second_loop.close()
+
+
+@pytest.mark.asyncio
+async def test_msgpack(rpc_server):
+    obj = {'bytes': b'\x00\xff', 'list': [1, 42, 'prologin'], 'ints': {42: 1}}
+    async with prologin.rpc.client.Client(
+        rpc_server, encoding='msgpack'
+    ) as rpc_client:
+        assert (await rpc_client.return_input(obj)) == obj
+        with pytest.raises(prologin.rpc.client.RemoteError) as e:
+            await rpc_client.raises_valueerror()
+        assert e.value.type == 'ValueError'
+        with pytest.raises(prologin.rpc.client.RemoteError) as e:
+            await rpc_client.missing_method()
+        assert e.value.type == 'MethodError'
+
+
+@pytest.mark.asyncio
+async def test_msgpack_overloaded(rpc_server):
+    async with prologin.rpc.client.Client(
+        rpc_server, encoding='msgpack'
+    ) as rpc_client:
+        running = asyncio.ensure_future(rpc_client.limited_sleep(0.3))
+        await asyncio.sleep(0.1)
+        queued = asyncio.ensure_future(rpc_client.limited_sleep(0))
+        await asyncio.sleep(0.1)
+        with pytest.raises(prologin.rpc.client.OverloadedError) as e:
+            await rpc_client.limited_sleep(0)
+        assert e.value.retry_after == 2
+        assert (await running) == 0.3
+        assert (await queued) == 0
+
+
+@pytest.mark.asyncio
+async def test_json_bytes(rpc_client):
+    with pytest.raises(ValueError):
+        await rpc_client.return_input(b'prologin')
+
+
+@pytest.mark.asyncio
+async def test_batch(rpc_client):
+    results = await rpc_client.batch(
+        [
+            ('return_number', []),
+            ('return_args_kwargs', [1, 'c'], {'kw1': 'a'}),
+            ('raises_valueerror', []),
+        ],
+        return_exceptions=True,
+    )
+    assert results[0] == 42
+    assert results[1] == [[1, 'c'], {'kw1': 'a', 'kw2': None}]
+    assert isinstance(results[2], prologin.rpc.client.RemoteError)
+    assert results[2].type == 'ValueError'
+
+    with pytest.raises(prologin.rpc.client.RemoteError) as e:
+        await rpc_client.batch(
+            [('missing_method', []), ('return_string', [])], sequential=True
+        )
+    assert e.value.type == 'MethodError'
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit(rpc_client):
+    running = asyncio.ensure_future(rpc_client.limited_sleep(0.5))
+    await asyncio.sleep(0.1)
+    queued = asyncio.ensure_future(rpc_client.limited_sleep(0.1))
+    await asyncio.sleep(0.1)
+    with pytest.raises(prologin.rpc.client.OverloadedError) as e:
+        await rpc_client.limited_sleep(0)
+    assert e.value.retry_after == 2
+    assert (await running) == 0.5
+    assert (await queued) == 0.1
+
+
+@pytest.mark.asyncio
+async def test_channel(rpc_client):
+    local = RPCServer('test-rpc-local')
+    async with prologin.rpc.websocket.connect(rpc_client, local.app) as peer:
+        serving = asyncio.ensure_future(peer.run())
+        assert (await peer.return_number()) == 42
+        with pytest.raises(prologin.rpc.client.RemoteError) as e:
+            await peer.raises_valueerror()
+        assert e.value.type == 'ValueError'
+        await peer.close()
+        await serving
+    with pytest.raises(ConnectionResetError):
+        await peer.return_number()
+
+
+@pytest.mark.asyncio
+async def test_channel_overloaded(rpc_client):
+    local = RPCServer('test-rpc-local')
+    async with prologin.rpc.websocket.connect(rpc_client, local.app) as peer:
+        serving = asyncio.ensure_future(peer.run())
+        running = asyncio.ensure_future(peer.limited_sleep(0.3))
+        await asyncio.sleep(0.1)
+        queued = asyncio.ensure_future(peer.limited_sleep(0))
+        await asyncio.sleep(0.1)
+        with pytest.raises(prologin.rpc.client.OverloadedError) as e:
+            await peer.limited_sleep(0)
+        assert e.value.retry_after == 2
+        assert (await running) == 0.3
+        assert (await queued) == 0
+        await peer.close()
+        await serving
+
+
+@pytest.mark.asyncio
+async def test_sync_client(rpc_server, event_loop):
+    rpc_client = prologin.rpc.client.SyncClient(rpc_server)
+    # The calls block, keep them out of the loop of the server
+    for _ in range(2):
+        res = await event_loop.run_in_executor(None, rpc_client.return_number)
+        assert res == 42
+
+
 GOOD_SECRET = b'secret42'
 BAD_SECRET = b'secret51'
 
@@ -165,6 +321,17 @@ async def test_missing_secret(rpc_server):
     assert e.value.type == 'MissingToken'
 
 
+@pytest.mark.asyncio
+@with_secret(GOOD_SECRET)
+async def test_batch_secret(rpc_server):
+    rpc_client = prologin.rpc.client.Client(rpc_server, secret=BAD_SECRET)
+    results = await rpc_client.batch(
+        [('return_number', []), ('public_hello', [])], return_exceptions=True
+    )
+    assert results[0].type == 'BadToken'
+    assert results[1] == 'hello'
+
+
 @pytest.mark.asyncio
 @with_secret(GOOD_SECRET)
 async def test_public_good_secret(rpc_server):
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import base64
+import hashlib
+import io
+import os
+import pytest
+import tarfile
+
+from prologin.workernode.cache import ChampionCache, ChampionTreeCache
+
+
+def make_tarball(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o600
+            tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def tarballs_of(count):
+    """Return `count` tarballs of a distinct 10 byte champion."""
+    return [
+        make_tarball({'champion.so': bytes([i] * 10)}) for i in range(count)
+    ]
+
+
+class Champions:
+    """Stand-in for a ChampionCache serving in-memory tarballs."""
+
+    def __init__(self, *tarballs):
+        self.tarballs = {hashlib.sha256(t).hexdigest(): t for t in tarballs}
+        self.requests = []
+
+    async def get(self, digest):
+        self.requests.append(digest)
+        return self.tarballs[digest]
+
+
+def set_mtime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.mark.asyncio
+async def test_champion_cache(tmp_path):
+    content = make_tarball({'champion.so': b'champion'})
+    digest = hashlib.sha256(content).hexdigest()
+    fetched = []
+
+    async def fetch(digest):
+        fetched.append(digest)
+        return base64.b64encode(content).decode()
+
+    cache = ChampionCache(tmp_path, 1024, fetch)
+    assert await cache.get(digest) == content
+    assert await cache.get(digest) == content
+    assert fetched == [digest]
+
+
+@pytest.mark.asyncio
+async def test_champion_cache_eviction(tmp_path):
+    contents = {hashlib.sha256(t).hexdigest(): t for t in tarballs_of(3)}
+    old, new, newest = contents
+    size = max(len(t) for t in contents.values())  # Two fit in the cache
+
+    async def fetch(digest):
+        return base64.b64encode(contents[digest]).decode()
+
+    # Left by a previous run
+    path = tmp_path / old[:2] / old
+    path.parent.mkdir()
+    path.write_bytes(contents[old])
+    set_mtime(path, 1)
+
+    cache = ChampionCache(tmp_path, 2 * size, fetch)
+    await cache.get(new)
+    assert list(cache.entries) == [old, new]
+    assert await cache.get(old) == contents[old]  # Now the most recent
+    await cache.get(newest)
+    assert list(cache.entries) == [old, newest]
+    assert cache.size == len(contents[old]) + len(contents[newest])
+    assert sorted(p.name for p in tmp_path.glob('*/*')) == sorted(
+        [old, newest]
+    )
+
+
+@pytest.mark.asyncio
+async def test_champion_cache_hash_mismatch(tmp_path):
+    async def fetch(digest):
+        return base64.b64encode(b'other').decode()
+
+    cache = ChampionCache(tmp_path, 1024, fetch)
+    with pytest.raises(ValueError):
+        await cache.get(hashlib.sha256(b'champion').hexdigest())
+    assert not list(tmp_path.glob('*/*'))
+
+
+@pytest.mark.asyncio
+async def test_tree_cache_extract(tmp_path):
+    content = make_tarball({'champion.so': b'champion'})
+    champions = Champions(content)
+    (digest,) = champions.tarballs
+    cache = ChampionTreeCache(tmp_path, 1024, champions)
+
+    path = await cache.get(digest)
+    assert path == tmp_path / digest
+    assert (path / 'champion.so').read_bytes() == b'champion'
+    # Readable by the isolate boxes
+    assert (path / 'champion.so').stat().st_mode & 0o444 == 0o444
+    assert cache.sizes == {digest: len(b'champion')}
+
+    assert await cache.get(digest) == path
+    assert champions.requests == [digest]
+
+
+@pytest.mark.asyncio
+async def test_tree_cache_eviction(tmp_path):
+    tarballs = tarballs_of(3)
+    champions = Champions(*tarballs)
+    old, new, newest = champions.tarballs
+    cache = ChampionTreeCache(tmp_path, 25, champions)
+
+    set_mtime(await cache.get(old), 1)
+    set_mtime(await cache.get(new), 2)
+    await cache.get(newest)
+    # The least recently used tree is removed
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([new, newest])
+    assert set(cache.sizes) == {new, newest}
+
+
+@pytest.mark.asyncio
+async def test_tree_cache_pinned(tmp_path):
+    tarballs = tarballs_of(3)
+    champions = Champions(*tarballs)
+    old, new, newest = champions.tarballs
+    cache = ChampionTreeCache(tmp_path, 25, champions)
+
+    with cache.pinned([old]):
+        set_mtime(await cache.get(old), 1)
+        set_mtime(await cache.get(new), 2)
+        await cache.get(newest)
+        assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+            [old, newest]
+        )
+    assert not cache.pins
+
+
+@pytest.mark.asyncio
+async def test_tree_cache_existing_trees(tmp_path):
+    tarballs = tarballs_of(2)
+    champions = Champions(*tarballs)
+    old, new = champions.tarballs
+    (tmp_path / old).mkdir()
+    (tmp_path / old / 'champion.so').write_bytes(bytes(20))
+    set_mtime(tmp_path / old, 1)
+    cache = ChampionTreeCache(tmp_path, 25, champions)
+
+    # Trees left by a previous run are measured and can be evicted
+    await cache.get(new)
+    assert [p.name for p in tmp_path.iterdir()] == [new]
+    assert champions.requests == [new]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import asyncio
+import pytest
+
+import prologin.workernode.inotify
+from prologin.workernode.inotify import wait_for_files
+
+
+@pytest.fixture(params=['inotify', 'polling'])
+def watch(request, monkeypatch):
+    if request.param == 'polling':
+
+        def unavailable(directory):
+            raise OSError('inotify is not available')
+
+        monkeypatch.setattr(
+            prologin.workernode.inotify, '_inotify_watch', unavailable
+        )
+
+
+async def create_later(path, delay=0.05):
+    await asyncio.sleep(delay)
+    path.write_bytes(b'')
+
+
+@pytest.mark.asyncio
+async def test_existing_files(watch, tmp_path):
+    paths = [tmp_path / 'a', tmp_path / 'b']
+    for path in paths:
+        path.write_bytes(b'')
+    await asyncio.wait_for(wait_for_files(paths, timeout=1), 1)
+
+
+@pytest.mark.asyncio
+async def test_created_files(watch, tmp_path):
+    paths = [tmp_path / 'a', tmp_path / 'b']
+    creators = asyncio.gather(*(create_later(p) for p in paths))
+    await asyncio.wait_for(wait_for_files(paths, timeout=5), 1)
+    await creators
+
+
+@pytest.mark.asyncio
+async def test_timeout(watch, tmp_path):
+    paths = [tmp_path / 'a', tmp_path / 'b']
+    (tmp_path / 'a').write_bytes(b'')
+    with pytest.raises(TimeoutError):
+        await wait_for_files(paths, timeout=0.1)
+
+
+@pytest.mark.asyncio
+async def test_abort(watch, tmp_path):
+    # e.g. the server exited before creating its sockets
+    abort = asyncio.ensure_future(asyncio.sleep(0.05))
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(
+            wait_for_files([tmp_path / 'a'], timeout=5, abort=abort), 1
+        )
@@ -8,12 +8,15 @@ import pathlib
 import subprocess
 import tarfile
 import tempfile
+import time
 import unittest
 import yaml
 
 from base64 import b64decode, b64encode
 
 from prologin.workernode import operations
+from prologin.workernode.cache import make_readable
+from prologin.workernode.pool import IsolatorPool
 
 # Helpers to get 'hello world' dummy libs
 
@@ -267,6 +270,105 @@ class FakeMatchTest(unittest.TestCase):
             gzip.decompress(b64decode(result['stats'])), b'STATS TEST\n'
         )
 
+        self.check_match_result(result)
+
+    def test_spawn_match_artifacts(self):
+        rules_so = get_hello_compiled_so()
+        ctgz = get_hello_compiled_tgz()
+
+        scripts = {
+            'stechec_server': STECHEC_FAKE_SERVER.encode(),
+            'stechec_client': STECHEC_FAKE_CLIENT.encode(),
+            'rules': rules_so,
+        }
+        with SetupScripts(
+            scripts
+        ) as scripts_paths, tempfile.TemporaryDirectory() as tmpdir:
+            champion_dir = os.path.join(tmpdir, 'champion')
+            artifacts_dir = os.path.join(tmpdir, 'artifacts')
+            os.mkdir(artifacts_dir)
+            config = get_worker_config(**scripts_paths)
+
+            # Champions extracted beforehand, as by the champion tree cache
+            operations.untar(b64decode(ctgz), champion_dir)
+            make_readable(pathlib.Path(tmpdir))
+            champion = pathlib.Path(champion_dir)
+            players = {42: [0, champion], 1337: [0, champion]}
+            map_contents = 'TEST_MAP'
+
+            async def spawn_match():
+                pool = IsolatorPool(2)
+                pool.start()
+                try:
+                    return await operations.spawn_match(
+                        config,
+                        players,
+                        map_contents,
+                        artifacts_dir=artifacts_dir,
+                        pool=pool,
+                    )
+                finally:
+                    await pool.close()
+
+            result = asyncio.run(spawn_match())
+
+            # The artifacts are left compressed in artifacts_dir
+            expected = {
+                'dump': b'DUMP TEST\n',
+                'replay': b'REPLAY TEST\n',
+                'stats': b'STATS TEST\n',
+            }
+            self.assertEqual(set(result['artifacts']), set(expected))
+            for name, content in expected.items():
+                path = pathlib.Path(result['artifacts'][name])
+                self.assertEqual(path.parent, pathlib.Path(artifacts_dir))
+                self.assertEqual(gzip.decompress(path.read_bytes()), content)
+                self.assertNotIn(name, result)
+
+        self.check_match_result(result)
+
+    def test_spawn_match_server_crash(self):
+        scripts = {
+            'stechec_server': b'#!/bin/sh\nexit 1\n',
+            'stechec_client': STECHEC_FAKE_CLIENT.encode(),
+            'rules': get_hello_compiled_so(),
+        }
+        with SetupScripts(scripts) as scripts_paths:
+            config = get_worker_config(**scripts_paths)
+            players = {42: [0, get_hello_compiled_tgz()]}
+
+            # The server exits without creating its sockets
+            result = asyncio.run(
+                operations.spawn_match(config, players, 'TEST_MAP')
+            )
+
+        self.assertFalse(result['success'])
+        self.assertIn('server did not start', result['error'])
+        self.assertEqual(result['players'], {})
+
+    def test_spawn_match_server_timeout(self):
+        scripts = {
+            'stechec_server': b'#!/bin/sh\nsleep 60\n',
+            'stechec_client': STECHEC_FAKE_CLIENT.encode(),
+            'rules': get_hello_compiled_so(),
+        }
+        with SetupScripts(scripts) as scripts_paths:
+            config = get_worker_config(**scripts_paths)
+            config['timeout']['server_start'] = 1
+            players = {42: [0, get_hello_compiled_tgz()]}
+
+            # The server never creates its sockets, it is stopped
+            start = time.monotonic()
+            result = asyncio.run(
+                operations.spawn_match(config, players, 'TEST_MAP')
+            )
+
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertFalse(result['success'])
+        self.assertIn('server did not start', result['error'])
+        self.assertEqual(result['players'], {})
+
+    def check_match_result(self, result):
         sr_expected = [
             {'player': 1, 'score': 42, 'nb_timeout': 0},
             {'player': 2, 'score': 1337, 'nb_timeout': 0},
@@ -289,3 +391,14 @@ class FakeMatchTest(unittest.TestCase):
             self.assertIn('map: TEST_MAP', player_result['stdout'])
             self.assertIn(f'name: {player_id}', player_result['stdout'])
             self.assertIn(f'client_id: {order_id}', player_result['stdout'])
+
+
+class CompressTest(unittest.TestCase):
+    def test_compress_b64(self):
+        # Spans several chunks, the base64 of each is concatenated
+        content = os.urandom(2 * operations.COMPRESS_CHUNK_SIZE + 1)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            result = operations.compress_b64(pathlib.Path(f.name), level=1)
+        self.assertEqual(gzip.decompress(b64decode(result)), content)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import pytest
+
+import prologin.workernode.pool
+from prologin.workernode.pool import IsolatorPool
+
+
+class FakeIsolator:
+    """Stand-in for camisole's Isolator, recording its init and cleanup."""
+
+    ids = itertools.count()
+    instances = []
+    fail_init = False
+
+    def __init__(self, opts, allowed_dirs=None):
+        self.opts = opts
+        self.allowed_dirs = allowed_dirs
+        self.path = 'box{}'.format(next(self.ids))
+        self.initialized = False
+        self.cleaned_up = False
+        self.instances.append(self)
+
+    async def __aenter__(self):
+        await asyncio.sleep(0)  # isolate --init runs in a subprocess
+        if self.fail_init:
+            raise RuntimeError('isolate --init failed')
+        self.initialized = True
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.cleaned_up = True
+
+
+@pytest.fixture
+def fake_isolator(monkeypatch):
+    monkeypatch.setattr(
+        prologin.workernode.pool.isolate, 'Isolator', FakeIsolator
+    )
+    monkeypatch.setattr(FakeIsolator, 'instances', [])
+    monkeypatch.setattr(FakeIsolator, 'fail_init', False)
+
+
+async def settle(pool):
+    """Wait for the background init and cleanup of the boxes."""
+    while pool.tasks:
+        await asyncio.gather(*pool.tasks)
+
+
+@pytest.mark.asyncio
+async def test_pool_start(fake_isolator):
+    pool = IsolatorPool(2)
+    pool.start()
+    await settle(pool)
+    assert len(pool.boxes) == 2
+    assert all(box.initialized for box in pool.boxes)
+
+
+@pytest.mark.asyncio
+async def test_pool_concurrent_refills(fake_isolator):
+    pool = IsolatorPool(2)
+    pool.start()
+    # e.g. boxes released while the pool is being filled
+    pool.spawn(pool.refill())
+    pool.spawn(pool.refill())
+    await settle(pool)
+    assert len(pool.boxes) == 2
+    assert len(FakeIsolator.instances) == 2
+
+
+@pytest.mark.asyncio
+async def test_pool_recycle(fake_isolator):
+    pool = IsolatorPool(2)
+    pool.start()
+    await settle(pool)
+    idle = list(pool.boxes)
+
+    async with pool.isolator({'time': 1}, ['/champion']) as isolator:
+        assert isolator is idle[0]
+        assert isolator.opts == {'time': 1}
+        assert isolator.allowed_dirs == ['/champion']
+        assert len(pool.boxes) == 1
+    await settle(pool)
+
+    # The used box is cleaned up and never handed out again
+    assert isolator.cleaned_up
+    assert len(pool.boxes) == 2
+    assert isolator not in pool.boxes
+    assert all(not box.cleaned_up for box in pool.boxes)
+
+
+@pytest.mark.asyncio
+async def test_pool_empty(fake_isolator):
+    pool = IsolatorPool(0)
+    pool.start()
+    # A box is initialized on the spot
+    async with pool.isolator({}, []) as isolator:
+        assert isolator.initialized
+    await settle(pool)
+    assert isolator.cleaned_up
+    assert not pool.boxes
+
+
+@pytest.mark.asyncio
+async def test_pool_init_failure(fake_isolator):
+    FakeIsolator.fail_init = True
+    pool = IsolatorPool(2)
+    pool.start()
+    await settle(pool)
+    assert not pool.boxes
+    with pytest.raises(RuntimeError):
+        async with pool.isolator({}, []):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_pool_close(fake_isolator):
+    pool = IsolatorPool(2)
+    pool.start()
+    await settle(pool)
+    idle = list(pool.boxes)
+    async with pool.isolator({}, []) as isolator:
+        pass
+    await pool.close()
+    assert isolator.cleaned_up
+    assert all(box.cleaned_up for box in idle)
+    assert not pool.boxes
+
+
+@pytest.mark.asyncio
+async def test_pool_close_while_filling(fake_isolator):
+    pool = IsolatorPool(2)
+    pool.start()
+    await asyncio.sleep(0)  # The boxes are being initialized
+    await pool.close()
+    # The boxes initialized in the meantime are not leaked
+    assert not pool.boxes
+    assert FakeIsolator.instances
+    assert all(box.cleaned_up for box in FakeIsolator.instances)
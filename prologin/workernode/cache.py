@@ -0,0 +1,295 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+
+from base64 import b64decode
+from pathlib import Path
+from typing import List
+
+from .monitoring import (
+    workernode_champion_cache_hit,
+    workernode_champion_cache_miss,
+    workernode_champion_tree_cache_hit,
+    workernode_champion_tree_cache_miss,
+)
+
+
+class ChampionCache:
+    """Persistent on-disk cache of the compiled champions, keyed by the
+    sha256 of their tarball.
+
+    Missing champions are fetched with `fetch`, a coroutine function taking a
+    hash and returning the base64-encoded tarball. Concurrent requests for
+    the same hash share a single fetch. The least recently used tarballs are
+    removed once the cache grows over `max_size` bytes.
+    """
+
+    def __init__(self, path: os.PathLike, max_size: int, fetch):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.fetch = fetch
+        self.fetching = {}
+        # Size of the cached tarballs, least recently used first, and their
+        # total. The tarballs already on disk are listed on the first fill.
+        self.entries = None
+        self.size = 0
+        self.listing = None
+
+    def entry_path(self, digest: str) -> Path:
+        return self.path / digest[:2] / digest
+
+    async def get(self, digest: str) -> bytes:
+        path = self.entry_path(digest)
+        loop = asyncio.get_event_loop()
+        try:
+            content = await loop.run_in_executor(None, path.read_bytes)
+        except FileNotFoundError:
+            workernode_champion_cache_miss.inc()
+        else:
+            workernode_champion_cache_hit.inc()
+            os.utime(path)  # Used as the LRU timestamp across restarts
+            if self.entries is not None and digest in self.entries:
+                self.entries.move_to_end(digest)
+            return content
+
+        if digest not in self.fetching:
+            self.fetching[digest] = asyncio.ensure_future(
+                self.fetch_entry(digest)
+            )
+        return await asyncio.shield(self.fetching[digest])
+
+    async def fetch_entry(self, digest: str) -> bytes:
+        try:
+            content = b64decode(await self.fetch(digest))
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.write, digest, content)
+            await self.add(digest, len(content))
+            return content
+        finally:
+            del self.fetching[digest]
+
+    def write(self, digest: str, content: bytes):
+        """Check and store a fetched tarball. Runs in an executor."""
+        if hashlib.sha256(content).hexdigest() != digest:
+            raise ValueError(f'champion {digest}: hash mismatch')
+        path = self.entry_path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so that a partial file is never visible
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix='.', delete=False
+        ) as f:
+            f.write(content)
+        os.replace(f.name, path)
+
+    def list_entries(self) -> collections.OrderedDict:
+        """Return the size of the tarballs on disk, least recently used
+        first. Runs in an executor."""
+        entries = []
+        for path in self.path.glob('*/*'):
+            if path.name.startswith('.'):  # Being written
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, path.name, st.st_size))
+        return collections.OrderedDict(
+            (digest, size) for _, digest, size in sorted(entries)
+        )
+
+    async def add(self, digest: str, size: int):
+        """Account for a new tarball, and evict the least recently used ones
+        while the cache is too large."""
+        loop = asyncio.get_event_loop()
+        if self.entries is None:
+            if self.listing is None:
+                self.listing = loop.run_in_executor(None, self.list_entries)
+            entries = await asyncio.shield(self.listing)
+            if self.entries is None:
+                self.entries = entries
+                self.size = sum(entries.values())
+
+        if digest in self.entries:
+            self.size -= self.entries.pop(digest)
+        self.entries[digest] = size
+        self.size += size
+
+        victims = []
+        while self.entries and self.size > self.max_size:
+            evicted, evicted_size = self.entries.popitem(last=False)
+            logging.debug('evicting champion %s from the cache', evicted)
+            victims.append(self.entry_path(evicted))
+            self.size -= evicted_size
+        if victims:
+            await loop.run_in_executor(None, remove_files, victims)
+
+
+class ChampionTreeCache:
+    """On-disk cache of the extracted champions, keyed by the sha256 of their
+    tarball.
+
+    The trees are extracted from the tarballs of `champions`, a
+    ChampionCache, and are made readable by everyone so that they can be
+    mounted read-only in the isolate boxes. The least recently used trees
+    are removed once the cache grows over `max_size` bytes, except the ones
+    pinned by a running match.
+    """
+
+    def __init__(self, path: os.PathLike, max_size: int, champions):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.champions = champions
+        self.extracting = {}
+        self.pins = collections.Counter()
+        # Size of the trees in bytes, measured once per tree
+        self.sizes = {}
+
+    @contextlib.contextmanager
+    def pinned(self, digests):
+        """Keep the trees of `digests` from being evicted."""
+        self.pins.update(digests)
+        try:
+            yield
+        finally:
+            self.pins.subtract(digests)
+            self.pins += collections.Counter()  # Drop the zero counts
+
+    async def get(self, digest: str) -> Path:
+        path = self.path / digest
+        if path.is_dir():
+            workernode_champion_tree_cache_hit.inc()
+            os.utime(path)  # Used as the LRU timestamp
+            return path
+
+        workernode_champion_tree_cache_miss.inc()
+        if digest not in self.extracting:
+            self.extracting[digest] = asyncio.ensure_future(
+                self.extract_entry(digest)
+            )
+        return await asyncio.shield(self.extracting[digest])
+
+    async def extract_entry(self, digest: str) -> Path:
+        try:
+            content = await self.champions.get(digest)
+            loop = asyncio.get_event_loop()
+            path = await loop.run_in_executor(
+                None, self.extract, digest, content
+            )
+            await self.evict()
+            return path
+        finally:
+            del self.extracting[digest]
+
+    def extract(self, digest: str, content: bytes) -> Path:
+        """Extract the tarball `content` as the tree of `digest`. Runs in an
+        executor."""
+        path = self.path / digest
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Extract then rename so that a partial tree is never visible
+        tmp_path = Path(tempfile.mkdtemp(dir=self.path, prefix='.'))
+        try:
+            with tarfile.open(fileobj=io.BytesIO(content)) as tarobj:
+                tarobj.extractall(tmp_path)
+            make_readable(tmp_path)
+            self.sizes[digest] = tree_size(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return path
+
+    def list_entries(self):
+        """Return the (mtime, size, path) of the trees. Runs in an executor,
+        as the trees found on disk at startup are measured once."""
+        entries = []
+        for path in self.path.iterdir():
+            if path.name.startswith('.'):  # Being extracted or removed
+                continue
+            try:
+                mtime = path.stat().st_mtime
+                if path.name not in self.sizes:
+                    self.sizes[path.name] = tree_size(path)
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, self.sizes[path.name], path))
+        return entries
+
+    async def evict(self):
+        loop = asyncio.get_event_loop()
+        entries = await loop.run_in_executor(None, self.list_entries)
+
+        # The victims are chosen and renamed on the event loop, so that a
+        # tree cannot be pinned and handed out while being removed.
+        size = sum(e[1] for e in entries)
+        victims = []
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            if self.pins[path.name]:
+                continue
+            logging.debug(
+                'evicting champion tree %s from the cache', path.name
+            )
+            trash = path.with_name('.evicted-' + path.name)
+            try:
+                os.rename(path, trash)
+            except FileNotFoundError:
+                continue
+            self.sizes.pop(path.name, None)
+            victims.append(trash)
+            size -= entry_size
+
+        if victims:
+            await loop.run_in_executor(None, remove_trees, victims)
+
+
+def make_readable(root: Path):
+    """Let everyone read the files and traverse the directories of a tree."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        os.chmod(dirpath, os.stat(dirpath).st_mode | 0o555)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path):
+                os.chmod(path, os.stat(path).st_mode | 0o444)
+
+
+def remove_files(paths: List[Path]):
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+def remove_trees(roots: List[Path]):
+    for root in roots:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def tree_size(root: Path) -> int:
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
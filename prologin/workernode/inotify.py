@@ -0,0 +1,112 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Wait for files to appear, using inotify(7) through the libc."""
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import time
+
+from typing import Iterable, Optional
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# Interval of the checks when inotify is not available
+POLL_INTERVAL_SECS = 0.05
+
+_libc = None
+
+
+def _inotify_watch(directory: str) -> int:
+    """Return an inotify file descriptor watching files appearing in
+    `directory`, or raise an OSError."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    mask = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+    if _libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, os.strerror(errno))
+    return fd
+
+
+async def wait_for_files(
+    paths: Iterable[os.PathLike],
+    timeout: float,
+    abort: Optional[asyncio.Future] = None,
+):
+    """Wait until all the `paths`, files of a same directory, can be read and
+    written.
+
+    Raise a TimeoutError after `timeout` seconds, or a RuntimeError if
+    `abort` completes first.
+    """
+    paths = [os.fspath(p) for p in paths]
+    loop = asyncio.get_event_loop()
+    deadline = time.monotonic() + timeout
+    changed = asyncio.Event()
+
+    def on_events():
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        changed.set()
+
+    try:
+        fd = _inotify_watch(os.path.dirname(paths[0]))
+    except (OSError, AttributeError):
+        fd = None
+    else:
+        loop.add_reader(fd, on_events)
+
+    try:
+        # The files are checked once the watch is set up, not to miss them
+        while not all(os.access(p, os.R_OK | os.W_OK) for p in paths):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('{} not created'.format(', '.join(paths)))
+            if abort is not None and abort.done():
+                raise RuntimeError('stopped before creating the files')
+            if fd is not None:
+                waiter = asyncio.ensure_future(changed.wait())
+                waiters = [waiter] if abort is None else [waiter, abort]
+                await asyncio.wait(
+                    waiters,
+                    timeout=remaining,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                waiter.cancel()
+                changed.clear()
+            else:
+                await asyncio.sleep(min(POLL_INTERVAL_SECS, remaining))
+    finally:
+        if fd is not None:
+            loop.remove_reader(fd)
+            os.close(fd)
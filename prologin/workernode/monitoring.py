@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
 
-from prometheus_client import start_http_server, Summary, Gauge
+from prometheus_client import start_http_server, Summary, Gauge, Counter
 
 workernode_compile_champion_summary = Summary(
     'workernode_compile_champion_summary', 'Summary of compile champion task'
@@ -27,6 +27,33 @@ workernode_run_match_summary = Summary(
 
 workernode_slots = Gauge('workernode_slots', 'Number of available slots')
 
+workernode_champion_cache_hit = Counter(
+    'workernode_champion_cache_hit', 'Number of champion cache hits'
+)
+
+workernode_champion_cache_miss = Counter(
+    'workernode_champion_cache_miss', 'Number of champion cache misses'
+)
+
+workernode_champion_tree_cache_hit = Counter(
+    'workernode_champion_tree_cache_hit',
+    'Number of extracted champion cache hits',
+)
+
+workernode_champion_tree_cache_miss = Counter(
+    'workernode_champion_tree_cache_miss',
+    'Number of extracted champion cache misses',
+)
+
+workernode_isolate_pool_hit = Counter(
+    'workernode_isolate_pool_hit', 'Number of boxes taken from the pool'
+)
+
+workernode_isolate_pool_miss = Counter(
+    'workernode_isolate_pool_miss',
+    'Number of boxes initialized because the pool was empty',
+)
+
 
 def monitoring_start():
     start_http_server(9020)
@@ -24,6 +24,7 @@ import io
 import logging
 import os
 import os.path
+import shutil
 import tarfile
 import tempfile
 import traceback
@@ -34,7 +35,8 @@ import yaml
 from base64 import b64decode, b64encode
 from camisole import isolate
 from pathlib import Path
-from tenacity import retry, stop_after_attempt, wait_fixed
+
+from . import inotify
 
 
 def tar(path: os.PathLike, compression: str = 'gz') -> bytes:
@@ -68,16 +70,40 @@ def untar(content: bytes, path: os.PathLike, compression: str = 'gz'):
         tarobj.extractall(path)
 
 
-def read_compress_b64(path: Path) -> str:
+# Size of the chunks read when compressing a file, a multiple of 3 so that
+# the base64 of each chunk can be concatenated
+COMPRESS_CHUNK_SIZE = 3 * 256 * 1024
+
+
+def compress_b64(path: Path, level: int = 6) -> str:
+    """
+    Gzip compress the given file and return a base64 of the result.
+
+    The file is compressed chunk by chunk to a temporary file, which is then
+    base64 encoded chunk by chunk: only the encoded result is held in memory.
+    """
+    with tempfile.TemporaryFile() as compressed:
+        compress_file(path, compressed, level)
+        compressed.seek(0)
+        chunks = iter(lambda: compressed.read(COMPRESS_CHUNK_SIZE), b'')
+        return ''.join(b64encode(chunk).decode() for chunk in chunks)
+
+
+def compress_file(src: Path, dst, level: int = 6):
     """
-    Read the given file, gzip compress it and return a base64 of the result.
+    Gzip compress the given file to `dst`, a path or a binary file object,
+    without loading it in memory.
     """
-    return b64encode(gzip.compress(path.read_bytes())).decode()
+    with src.open('rb') as fin, gzip.open(
+        dst, 'wb', compresslevel=level
+    ) as fout:
+        shutil.copyfileobj(fin, fout, COMPRESS_CHUNK_SIZE)
 
 
 class Operation:
-    def __init__(self, config):
+    def __init__(self, config, pool=None):
         self.config = config
+        self.pool = pool
         self.isolator = None
         self.isolate_limits: Dict[str, Any] = {}
         self.isolate_allowed_dirs: List[str] = []
@@ -88,12 +114,22 @@ class Operation:
             'stderr': None,
         }
 
+    @contextlib.asynccontextmanager
+    async def new_isolator(self):
+        if self.pool is not None:
+            async with self.pool.isolator(
+                self.isolate_limits, self.isolate_allowed_dirs
+            ) as isolator:
+                yield isolator
+        else:
+            async with isolate.Isolator(
+                self.isolate_limits, allowed_dirs=self.isolate_allowed_dirs
+            ) as isolator:
+                yield isolator
+
     @contextlib.asynccontextmanager
     async def spawn_isolator(self):
-        isolator = isolate.Isolator(
-            self.isolate_limits, allowed_dirs=self.isolate_allowed_dirs
-        )
-        async with isolator:
+        async with self.new_isolator() as isolator:
             self.isolator = isolator
             try:
                 yield isolator
@@ -198,6 +234,7 @@ class SpawnServer(Operation):
             'dump': None,
             'replay': None,
             'stats': None,
+            'artifacts': None,
             'match_result': None,
             **self.result,
         }
@@ -218,6 +255,7 @@ class SpawnServer(Operation):
         pub_addr: str,
         nb_players: int,
         map_content: str,
+        artifacts_dir: os.PathLike = None,
     ):
         self.isolate_allowed_dirs.append(str(sockets_dir) + ':rw')
         # fmt: off
@@ -246,15 +284,44 @@ class SpawnServer(Operation):
                     self.isolator.isolate_retcode
                 )
             )
-        self.result['dump'] = read_compress_b64(
-            self.isolator.path / 'dump.json'
-        )
-        self.result['replay'] = read_compress_b64(
-            self.isolator.path / "replay"
-        )
-        self.result['stats'] = read_compress_b64(
-            self.isolator.path / "stats.yaml"
+
+        outputs = {
+            'dump': self.isolator.path / 'dump.json',
+            'replay': self.isolator.path / 'replay',
+            'stats': self.isolator.path / 'stats.yaml',
+        }
+        # Compress the outputs out of the event loop, the dumps of long
+        # matches can weigh hundreds of MB.
+        loop = asyncio.get_event_loop()
+        level = self.config.get('worker', {}).get(
+            'artifact_compression_level', 6
         )
+        if artifacts_dir is None:
+            contents = await asyncio.gather(
+                *(
+                    loop.run_in_executor(None, compress_b64, path, level)
+                    for path in outputs.values()
+                )
+            )
+            self.result.update(zip(outputs, contents))
+        else:
+            # Compress the artifacts out of the box, to be uploaded separately
+            self.result['artifacts'] = {}
+            for name in outputs:
+                artifact_path = Path(artifacts_dir) / (name + '.gz')
+                self.result['artifacts'][name] = str(artifact_path)
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        None,
+                        compress_file,
+                        path,
+                        self.result['artifacts'][name],
+                        level,
+                    )
+                    for name, path in outputs.items()
+                )
+            )
 
 
 class SpawnClient(Operation):
@@ -291,7 +358,8 @@ class SpawnClient(Operation):
         sub_addr: str,
         champion_id: int,
         player_id: int,
-        champion_tgz_b64: str,
+        champion_tgz_b64: str = None,
+        champion_dir: os.PathLike = None,
         map_content: str = None,
         order_id: int = None,
     ):
@@ -299,7 +367,14 @@ class SpawnClient(Operation):
 
         self.isolate_allowed_dirs.append(str(sockets_dir) + ':rw')
 
-        champion_path = self.extract_champion(champion_tgz_b64)
+        if champion_dir is not None:
+            # An already extracted champion, shared by its concurrent matches
+            champion_path = Path('/champion')
+            self.isolate_allowed_dirs.append(
+                '{}={}'.format(champion_path, champion_dir)
+            )
+        else:
+            champion_path = self.extract_champion(champion_tgz_b64)
         env: Dict[str, str] = {
             'CHAMPION_PATH': str(champion_path),
             'HOME': '/tmp',
@@ -327,12 +402,14 @@ class SpawnClient(Operation):
         await self.isolator.run(cmd, env=env, merge_outputs=True)
 
 
-async def compile_champion(config, champion_tgz_b64):
-    compile_champion = CompileChampion(config)
+async def compile_champion(config, champion_tgz_b64, pool=None):
+    compile_champion = CompileChampion(config, pool)
     return await compile_champion(champion_tgz_b64=champion_tgz_b64)
 
 
-async def spawn_match(config, players, map_content):
+async def spawn_match(
+    config, players, map_content, artifacts_dir=None, pool=None
+):
     # Build the domain sockets
     socket_dir = tempfile.TemporaryDirectory(prefix='workernode-match-')
     os.chmod(socket_dir.name, 0o777)
@@ -342,7 +419,7 @@ async def spawn_match(config, players, map_content):
     s_pubsub = 'ipc://' + f_pubsub
 
     # Server task
-    spawn_server = SpawnServer(config)
+    spawn_server = SpawnServer(config, pool)
     task_server = asyncio.create_task(
         spawn_server(
             sockets_dir=socket_dir.name,
@@ -350,25 +427,53 @@ async def spawn_match(config, players, map_content):
             pub_addr=s_pubsub,
             nb_players=len(players),
             map_content=map_content,
+            artifacts_dir=artifacts_dir,
         )
     )
-    await asyncio.sleep(0.1)  # Let the server start
 
-    @retry(reraise=True, stop=stop_after_attempt(7), wait=wait_fixed(2))
-    async def wait_for_server_sockets():
-        if not all(
-            os.access(f, os.R_OK | os.W_OK) for f in (f_reqrep, f_pubsub)
-        ):
-            raise RuntimeError("Server socket was not created")
-
-    await wait_for_server_sockets()
+    # Start the players as soon as the server sockets are created
+    try:
+        await inotify.wait_for_files(
+            (f_reqrep, f_pubsub),
+            timeout=config['timeout'].get('server_start', 15),
+            abort=task_server,
+        )
+    except BaseException as e:
+        # Do not leave the server running without its players
+        task_server.cancel()
+        (server_result,) = await asyncio.gather(
+            task_server, return_exceptions=True
+        )
+        if not isinstance(e, (TimeoutError, RuntimeError)):
+            raise
+        logging.error('match server did not start: %s', e)
+        # Report the failure right away, like the other match errors
+        result = {'stdout': None, 'stderr': None}
+        if isinstance(server_result, dict):  # The server exited
+            result.update(server_result)
+        result.update(
+            success=False,
+            error='server did not start: {}'.format(
+                result.get('error') or e
+            ),
+            traceback=result.get('traceback') or traceback.format_exc(),
+            players={},
+        )
+        return result
 
     # Players tasks
     tasks_players = {}
 
     player_iter = sorted(players.items())  # Sort by MatchPlayer id
-    for order_id, (player_id, (champion_id, ctgz)) in enumerate(player_iter):
-        spawn_client = SpawnClient(config)
+    for order_id, (player_id, (champion_id, champion)) in enumerate(
+        player_iter
+    ):
+        # Champions are either base64 tarballs or extracted directories
+        if isinstance(champion, os.PathLike):
+            champion_args = {'champion_dir': champion}
+        else:
+            champion_args = {'champion_tgz_b64': champion}
+        spawn_client = SpawnClient(config, pool)
         task_client = asyncio.create_task(
             spawn_client(
                 sockets_dir=socket_dir.name,
@@ -376,9 +481,9 @@ async def spawn_match(config, players, map_content):
                 sub_addr=s_pubsub,
                 champion_id=champion_id,
                 player_id=player_id,
-                champion_tgz_b64=ctgz,
                 map_content=map_content,
                 order_id=order_id,
+                **champion_args,
             )
         )
         tasks_players[player_id] = task_client
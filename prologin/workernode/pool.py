@@ -0,0 +1,119 @@
+# This file is part of Prologin-SADM.
+#
+# Copyright (c) 2020 Association Prologin <info@prologin.org>
+#
+# Prologin-SADM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Prologin-SADM is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Prologin-SADM.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import contextlib
+import logging
+
+from camisole import isolate
+from typing import Any, Dict, List
+
+from .monitoring import (
+    workernode_isolate_pool_hit,
+    workernode_isolate_pool_miss,
+)
+
+
+class IsolatorPool:
+    """Pool of initialized isolate boxes.
+
+    Initializing a box (isolate --init) and cleaning it up (isolate
+    --cleanup) each take a few process spawns. The pool keeps up to `size`
+    boxes initialized in advance, hands them out with `isolator()`, and
+    cleans up the used boxes and initializes their replacements in the
+    background. A box is never reused for two runs.
+
+    When the pool is empty, a box is initialized on the spot.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.boxes = collections.deque()
+        self.initializing = 0
+        self.tasks = set()
+
+    def start(self):
+        for _ in range(self.size):
+            self.spawn(self.refill())
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @staticmethod
+    async def init_box() -> isolate.Isolator:
+        # The limits and the allowed directories are only used when running
+        # a command, they are set when the box is handed out.
+        isolator = isolate.Isolator({}, allowed_dirs=[])
+        await isolator.__aenter__()
+        return isolator
+
+    async def refill(self):
+        # Concurrent refills must not initialize more than the missing boxes
+        if len(self.boxes) + self.initializing >= self.size:
+            return
+        self.initializing += 1
+        try:
+            isolator = await self.init_box()
+        except Exception:
+            logging.exception('cannot initialize an isolate box')
+            return
+        finally:
+            self.initializing -= 1
+        if len(self.boxes) >= self.size:
+            # The pool was closed in the meantime
+            await self.recycle(isolator)
+        else:
+            self.boxes.append(isolator)
+
+    async def recycle(self, isolator: isolate.Isolator):
+        try:
+            await isolator.__aexit__(None, None, None)
+        except Exception:
+            logging.exception('cannot clean up isolate box %s', isolator.path)
+        await self.refill()
+
+    @contextlib.asynccontextmanager
+    async def isolator(
+        self, limits: Dict[str, Any], allowed_dirs: List[str]
+    ) -> isolate.Isolator:
+        """Hand out a box running with `limits` and `allowed_dirs`.
+
+        The outputs of the box must be read before leaving the context, the
+        box being cleaned up afterwards.
+        """
+        if self.boxes:
+            workernode_isolate_pool_hit.inc()
+            isolator = self.boxes.popleft()
+        else:
+            workernode_isolate_pool_miss.inc()
+            isolator = await self.init_box()
+        isolator.opts = limits
+        isolator.allowed_dirs = allowed_dirs
+        try:
+            yield isolator
+        finally:
+            self.spawn(self.recycle(isolator))
+
+    async def close(self):
+        """Wait for the background tasks and clean up the idle boxes."""
+        self.size = 0
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        while self.boxes:
+            await self.recycle(self.boxes.popleft())
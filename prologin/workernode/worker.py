@@ -23,17 +23,23 @@ import logging
 import logging.handlers
 import prologin.rpc.client
 import prologin.rpc.server
+import prologin.rpc.websocket
 import socket
+import tempfile
 import time
+import traceback
 
 from tenacity import (
     retry,
     stop_after_attempt,
-    wait_fixed,
     retry_if_exception_type,
 )
 
+from pathlib import Path
+
 from . import operations
+from .cache import ChampionCache, ChampionTreeCache
+from .pool import IsolatorPool
 
 from .monitoring import (
     workernode_slots,
@@ -42,30 +48,26 @@ from .monitoring import (
 )
 
 
+def wait_master(retry_state):
+    """Wait as long as an overloaded master asks to, 10 seconds otherwise."""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, prologin.rpc.client.OverloadedError):
+        return exc.retry_after
+    return 10
+
+
 def async_work(func=None, slots=0):
     if func is None:
         return functools.partial(async_work, slots=slots)
 
     @functools.wraps(func)
     async def mktask(self, *args, **kwargs):
-        async def wrapper(self, *wargs, **wkwargs):
-            if self.slots < slots:
-                logging.warning('not enough slots to start the required job')
-                return
-            logging.debug('starting a job for %s slots', slots)
-            self.slots -= slots
-            workernode_slots.set(self.slots)
-            await self.update_master()
-            try:
-                await func(self, *wargs, **wkwargs)
-            finally:
-                self.slots += slots
-                workernode_slots.set(self.slots)
-                await self.update_master()
-
-        asyncio.Task(wrapper(self, *args, **kwargs), loop=self.loop)
+        self.start_job(func, slots, *args, **kwargs)
         return slots
 
+    # Used by run_tasks to start the job of a batch
+    mktask.job = func
+    mktask.slots = slots
     return mktask
 
 
@@ -80,11 +82,41 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
         self.slots = self.max_slots = config['worker']['available_slots']
         self.matches = {}
         self.loop = asyncio.get_event_loop()
-        self.master = self.get_master()
+        self.master_client = self.get_master()
+        # Optional channel to the master, preferred to HTTP calls when open
+        self.use_channel = config['master'].get('websocket', False)
+        self.channel = None
+        self.app.on_cleanup.append(self.close_master)
+        self.master_update = None
+        self.master_dirty = False
+        self.champions = ChampionCache(
+            config['worker'].get(
+                'champion_cache_dir', '/var/cache/workernode/champions'
+            ),
+            config['worker'].get('champion_cache_MiB', 1024) * 1024 * 1024,
+            lambda champion_hash: self.master.get_champion(champion_hash),
+        )
+        self.champion_trees = ChampionTreeCache(
+            config['worker'].get(
+                'champion_tree_cache_dir',
+                '/var/cache/workernode/champion-trees',
+            ),
+            config['worker'].get('champion_tree_cache_MiB', 2048)
+            * 1024
+            * 1024,
+            self.champions,
+        )
+        self.isolators = IsolatorPool(
+            config['worker'].get('isolate_pool_size', self.max_slots)
+        )
+        self.app.on_cleanup.append(self.close_isolators)
 
     def run(self):
         logging.info('worker listening on %s', self.config['worker']['port'])
         asyncio.Task(self.send_heartbeat())
+        self.isolators.start()
+        if self.use_channel:
+            asyncio.Task(self.channel_task())
         super().run(port=self.config['worker']['port'])
 
     def stop(self):
@@ -98,15 +130,93 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
         host, port = (config['master']['host'], config['master']['port'])
         url = "http://{}:{}/".format(host, port)
         return prologin.rpc.client.Client(
-            url, secret=config['master']['shared_secret'].encode('utf-8')
+            url,
+            secret=config['master']['shared_secret'].encode('utf-8'),
+            encoding=config['master'].get('rpc_encoding', 'json'),
         )
 
+    @property
+    def master(self):
+        if self.channel is not None and not self.channel.closed:
+            return self.channel
+        return self.master_client
+
+    async def close_master(self, app):
+        await self.master_client.close()
+
+    async def close_isolators(self, app):
+        await self.isolators.close()
+
+    async def channel_task(self):
+        """Keep a channel open to the master.
+
+        The calls in both directions go through the channel while it is open,
+        and the master notices right away when the worker goes down.
+        """
+        params = {'hostname': self.hostname, 'port': self.port}
+        while True:
+            try:
+                async with prologin.rpc.websocket.connect(
+                    self.master_client, self.app, params
+                ) as channel:
+                    logging.info('channel to the master opened')
+                    self.channel = channel
+                    self.notify_master()
+                    await channel.run()
+                logging.warning('channel to the master closed')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning('cannot open channel to the master: %s', e)
+            finally:
+                self.channel = None
+            await asyncio.sleep(self.interval)
+
     async def update_master(self):
         try:
             await self.master.update_worker(self.get_worker_infos())
         except socket.error:
             logging.warning('master down, cannot update it')
 
+    def notify_master(self):
+        """Send our slots to the master in the background.
+
+        Updates requested while another one is in flight are coalesced into
+        a single call.
+        """
+        self.master_dirty = True
+        if self.master_update is None or self.master_update.done():
+            self.master_update = asyncio.Task(
+                self.send_master_updates(), loop=self.loop
+            )
+
+    async def send_master_updates(self):
+        while self.master_dirty:
+            self.master_dirty = False
+            await self.update_master()
+
+    def start_job(self, func, slots, *args, **kwargs):
+        """Start `func` in the background if there are enough free slots."""
+        if self.slots < slots:
+            logging.warning('not enough slots to start the required job')
+            return False
+        logging.debug('starting a job for %s slots', slots)
+        self.slots -= slots
+        workernode_slots.set(self.slots)
+        self.notify_master()
+        asyncio.Task(
+            self.run_job(func, slots, *args, **kwargs), loop=self.loop
+        )
+        return True
+
+    async def run_job(self, func, slots, *args, **kwargs):
+        try:
+            await func(self, *args, **kwargs)
+        finally:
+            self.slots += slots
+            workernode_slots.set(self.slots)
+            self.notify_master()
+
     async def send_heartbeat(self):
         logging.debug(
             'sending heartbeat to the server, %s/%s slots',
@@ -131,12 +241,34 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
     async def reachable(self):
         return True
 
+    @prologin.rpc.remote_method
+    async def run_tasks(self, compilations=(), matches=()):
+        """Start a batch of compilations and matches.
+
+        Return the ids of the champions and matches that were started, the
+        others were rejected for lack of free slots.
+        """
+        started = {'compilations': [], 'matches': []}
+        for user, cid, ctgz in compilations:
+            method = WorkerNode.compile_champion
+            if self.start_job(method.job, method.slots, user, cid, ctgz):
+                started['compilations'].append(cid)
+        for match_id, players, map_contents in matches:
+            method = WorkerNode.run_match
+            if self.start_job(
+                method.job, method.slots, match_id, players, map_contents
+            ):
+                started['matches'].append(match_id)
+        return started
+
     @prologin.rpc.remote_method
     @async_work(slots=1)
     async def compile_champion(self, user, cid, ctgz):
         logging.info('compilation %s: starting', cid)
         compile_champion_start = time.monotonic()
-        result = await operations.compile_champion(self.config, ctgz)
+        result = await operations.compile_champion(
+            self.config, ctgz, self.isolators
+        )
         workernode_compile_champion_summary.observe(
             max(time.monotonic() - compile_champion_start, 0)
         )
@@ -145,8 +277,10 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
         @retry(
             reraise=True,
             stop=stop_after_attempt(15),
-            wait=wait_fixed(10),
-            retry=retry_if_exception_type(socket.error),
+            wait=wait_master,
+            retry=retry_if_exception_type(
+                (socket.error, prologin.rpc.client.OverloadedError)
+            ),
         )
         async def send_master_result():
             await self.master.compilation_done(
@@ -160,6 +294,11 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
             await send_master_result()
         except socket.error:
             logging.warning('master down, cannot send compiled %s', cid)
+        except prologin.rpc.client.RemoteError as e:
+            # Including an OverloadedError once the retries are exhausted
+            logging.warning(
+                'master rejected compiled %s: %s: %s', cid, e.type, e.message
+            )
         else:
             logging.info('compilation %s: sent to masternode', cid)
 
@@ -168,32 +307,96 @@ class WorkerNode(prologin.rpc.server.BaseRPCApp):
     async def run_match(self, match_id, players, map_contents=None):
         logging.info('match %s: started', match_id)
         run_match_start = time.monotonic()
-        result = await operations.spawn_match(
-            self.config, players, map_contents
-        )
-        workernode_run_match_summary.observe(
-            max(time.monotonic() - run_match_start, 0)
-        )
-        logging.info('match %s: done', match_id)
 
-        @retry(
-            reraise=True,
-            stop=stop_after_attempt(15),
-            wait=wait_fixed(10),
-            retry=retry_if_exception_type(socket.error),
-        )
-        async def send_master_result():
-            await self.master.match_done(
-                self.get_worker_infos(),
-                match_id,
-                result,
+        # The master only sends the hash of the champions
+        hashes = list({chash for _, chash in players.values()})
+
+        with tempfile.TemporaryDirectory(
+            prefix='workernode-artifacts-'
+        ) as artifacts_dir:
+            # The extracted champions are mounted read-only in the boxes,
+            # they must stay in the cache until the end of the match.
+            with self.champion_trees.pinned(hashes):
+                try:
+                    trees = await asyncio.gather(
+                        *(self.champion_trees.get(chash) for chash in hashes)
+                    )
+                except Exception as e:
+                    logging.exception(
+                        'match %s: cannot get the champions', match_id
+                    )
+                    # Let the master know right away, like the errors of the
+                    # match operations
+                    result = {
+                        'success': False,
+                        'error': 'cannot get the champions: {}'.format(e),
+                        'traceback': traceback.format_exc(),
+                        'stdout': None,
+                        'stderr': None,
+                        'players': {},
+                    }
+                else:
+                    trees = dict(zip(hashes, trees))
+                    players = {
+                        player_id: (champion_id, trees[chash])
+                        for player_id, (champion_id, chash) in players.items()
+                    }
+                    result = await operations.spawn_match(
+                        self.config,
+                        players,
+                        map_contents,
+                        Path(artifacts_dir),
+                        self.isolators,
+                    )
+            workernode_run_match_summary.observe(
+                max(time.monotonic() - run_match_start, 0)
             )
+            logging.info('match %s: done', match_id)
 
-        try:
-            await send_master_result()
-        except socket.error:
-            logging.warning(
-                'master down, cannot send match %s result', match_id
+            # The artifacts are streamed to the master, which only receives
+            # the metadata and scores through match_done.
+            artifacts = result.pop('artifacts', None) or {}
+
+            @retry(
+                reraise=True,
+                stop=stop_after_attempt(15),
+                wait=wait_master,
+                retry=retry_if_exception_type(
+                    (socket.error, prologin.rpc.client.OverloadedError)
+                ),
             )
-        else:
-            logging.info('match %s: sent to masternode', match_id)
+            async def send_master_result():
+                for name, path in artifacts.items():
+                    with open(path, 'rb') as f:
+                        await self.master_client.upload(
+                            'artifact/{}/{}/{}/{}'.format(
+                                self.hostname, self.port, match_id, name
+                            ),
+                            f,
+                        )
+                await self.master.match_done(
+                    self.get_worker_infos(),
+                    match_id,
+                    result,
+                )
+
+            try:
+                await send_master_result()
+            except socket.error:
+                logging.warning(
+                    'master down, cannot send match %s result', match_id
+                )
+            except prologin.rpc.client.InternalError:
+                logging.exception(
+                    'master refused match %s artifacts', match_id
+                )
+            except prologin.rpc.client.RemoteError as e:
+                # Including an OverloadedError once the retries are exhausted
+                logging.warning(
+                    'master rejected match %s result: %s: %s',
+                    match_id,
+                    e.type,
+                    e.message,
+                )
+            else:
+                logging.info('match %s: sent to masternode', match_id)